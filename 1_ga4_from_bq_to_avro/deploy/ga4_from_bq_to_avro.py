@@ -1,8 +1,26 @@
+import sys
+import os
+import time
+import json
+import datetime
+import hashlib
+import threading
+import zlib
 import traceback
 from pathlib import Path
 import configparser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage, bigquery
 
+AVRO_MAGIC = b"Obj\x01"
+AVRO_DEFLATE_LEVEL = 6
+METHODS = ("extract", "storage_read")
+
+
+class MyException(Exception):
+    pass
+
 
 def read_config(config_path):
     config = configparser.ConfigParser()
@@ -15,11 +33,52 @@ def gs_path_exists(gs_bucket, gs_path):
     return blob.exists()
 
 
-def from_bq_to_gs(dataset_ref, table_name, bq_client, gs_path):
+def read_projection(config, table):
+    # [projection] 残す列と event_name（どちらも空なら全て残す）
+    # event_dateはパーティションのキーなので必ず残し、列の順番はテーブルのスキーマのままにする
+    # event_namesを指定した場合は、(2)でも絞り込めるようにevent_nameも残す
+    projection_list = []
+    for key in ("columns", "event_names"):
+        projection_list.append(tuple([name.strip() for name in config.get("projection", key, fallback="").split(",")
+                                      if name.strip() != ""]))
+    columns, event_names = projection_list
+    if 0 < len(columns):
+        field_name_list = [field.name for field in table.schema]
+        for column in columns:
+            if column not in field_name_list:
+                raise MyException(f"projection.columnsの列がありません：{column}")
+        required_list = ["event_date"] + (["event_name"] if 0 < len(event_names) else [])
+        columns = tuple([field_name for field_name in field_name_list if field_name in columns or field_name in required_list])
+    return columns, event_names
+
+
+def projection_identity(columns, event_names):
+    # 前回の処理時と同じ列・event_nameで抽出したかどうかを判定するための値（絞り込まない場合はNone）
+    if len(columns) == 0 and len(event_names) == 0:
+        return None
+    return {"columns": sorted(columns), "event_names": sorted(event_names)}
+
+
+def start_bq_to_gs(dataset_ref, table_name, bq_client, gs_path):
+    # 抽出ジョブを投入するだけで、完了は待たない
     table_ref = dataset_ref.table(table_name)
     job_config = bigquery.ExtractJobConfig(compression="DEFLATE", destination_format="AVRO")
-    job = bq_client.extract_table(table_ref, gs_path, job_config=job_config)
-    job.result()
+    return bq_client.extract_table(table_ref, gs_path, job_config=job_config)
+
+
+def start_bq_query(dataset_ref, table_name, bq_client, columns, event_names, temp_dataset_ref=None):
+    # 列とevent_nameを絞り込むクエリのジョブを投入するだけで、完了は待たない（結果のテーブルを start_bq_to_gs() で抽出する）
+    # temp_dataset_refを指定しなければ、結果はクエリの一時テーブル（24時間で消える）に書かれる
+    select_list = ", ".join([f"`{column}`" for column in columns]) if 0 < len(columns) else "*"
+    query = f"SELECT {select_list} FROM `{dataset_ref.project}.{dataset_ref.dataset_id}.{table_name}`"
+    job_config = bigquery.QueryJobConfig()
+    if 0 < len(event_names):
+        query += " WHERE event_name IN UNNEST(@event_names)"
+        job_config.query_parameters = [bigquery.ArrayQueryParameter("event_names", "STRING", list(event_names))]
+    if temp_dataset_ref is not None:
+        job_config.destination = temp_dataset_ref.table(table_name)
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    return bq_client.query(query, job_config=job_config)
 
 
 def from_gs_to_local(gs_bucket, gs_path, local_path):
@@ -27,16 +86,410 @@ def from_gs_to_local(gs_bucket, gs_path, local_path):
     blob.download_to_filename(local_path)
 
 
+def download_table(gs_bucket, gs_path, local_path):
+    # 一時ファイルにダウンロードしてから名前を変える（中断されたファイルを完了と誤認しない）
+    local_path.parent.mkdir(parents=True, exist_ok=True)    # ディレクトリがなければ作成
+    part_path = local_path.with_name(local_path.name + ".part")
+    from_gs_to_local(gs_bucket, gs_path, part_path)
+    os.replace(part_path, local_path)
+    print(f"  ... done: {local_path}")
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fi:
+        for data in iter(lambda: fi.read(1024 * 1024), b""):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def read_manifest(manifest_path):
+    # 3つのステージで共有する、パーティションごとの処理状況
+    if manifest_path is None or not manifest_path.exists():
+        return {"partitions": {}}
+    with open(manifest_path, "rt", encoding="utf-8") as fi:
+        return json.load(fi)
+
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, "wt", encoding="utf-8") as fo:
+        json.dump(manifest, fo, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+class StageMetrics:
+    # パーティションごとの処理時間・行数・バイト数を、JSON Lines と Prometheus の textfile に書き出す
+    # （どちらもパスの指定がなければ書き出さない）
+    def __init__(self, stage, jsonl_path=None, prometheus_path=None):
+        self.stage = stage
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.record_list = []
+        self.error_count = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, partition, seconds, rows=None, bytes_in=None, bytes_out=None, **extra):
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "stage": self.stage,
+            "partition": partition,
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "rows_per_sec": round(rows / seconds, 1) if rows is not None and 0 < seconds else None,
+        }
+        record.update({key: round(value, 3) if type(value) is float else value for key, value in extra.items()})
+        with self.lock:
+            self.record_list.append(record)
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, "at", encoding="utf-8") as fo:
+                    fo.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def record_error(self):
+        with self.lock:
+            self.error_count += 1
+
+    def write_prometheus(self):
+        # node_exporterのtextfileコレクターが書きかけのファイルを読まないように、一時ファイルから名前を変える
+        if self.prometheus_path is None:
+            return
+        # 同じパーティションを複数回記録した場合は最後の値を使う
+        latest_dict = {record["partition"]: record for record in self.record_list}
+        value_dict = {}
+        for record in latest_dict.values():
+            for key, value in record.items():
+                if key not in ("time", "stage", "partition") and type(value) in (int, float):
+                    value_dict.setdefault(key, []).append((record["partition"], value))
+        lines = []
+        for key, value_list in value_dict.items():
+            name = f"ga4_partition_{key.replace('_per_sec', '_per_second')}"
+            lines.append(f"# TYPE {name} gauge\n")
+            for partition, value in value_list:
+                lines.append(f'{name}{{stage="{self.stage}",partition="{partition}"}} {value}\n')
+        for name, value in (("ga4_stage_partitions", len(latest_dict)),
+                            ("ga4_stage_errors", self.error_count),
+                            ("ga4_stage_rows", sum([record["rows"] or 0 for record in latest_dict.values()])),
+                            ("ga4_stage_seconds", round(time.time() - self.start, 3)),
+                            ("ga4_stage_last_run_timestamp_seconds", round(time.time(), 3))):
+            lines.append(f"# TYPE {name} gauge\n")
+            lines.append(f'{name}{{stage="{self.stage}"}} {value}\n')
+        tmp_path = self.prometheus_path.with_name(self.prometheus_path.name + ".tmp")
+        with open(tmp_path, "wt", encoding="utf-8") as fo:
+            fo.writelines(lines)
+        os.replace(tmp_path, self.prometheus_path)
+
+
+def open_stage_metrics(config, stage):
+    # [metrics] jsonl_path / prometheus_path（指定がなければ書き出さない）
+    path_list = []
+    for key in ("jsonl_path", "prometheus_path"):
+        path_str = config.get("metrics", key, fallback="")
+        path_list.append(Path.cwd() / path_str if path_str != "" else None)
+    return StageMetrics(stage, *path_list)
+
+
+def check_table(table_name, local_path, dataset_ref, bq_client, manifest, manifest_path, projection):
+    # 前回の処理状況から (BigQueryのテーブルの更新日時・行数等, 作り直すか) を返す
+    # BigQueryのテーブルが更新されていれば、GCS・localのファイルは使わない。localのファイルが記録と違えば消す
+    source = {}
+    stale = False
+    if manifest_path is not None:
+        table = bq_client.get_table(dataset_ref.table(table_name))
+        source = {"modified": table.modified.isoformat(), "num_rows": table.num_rows, "projection": projection}
+        entry = manifest["partitions"].get(table_name, {}).get("bq_to_avro")
+        if entry is not None:
+            stale = entry.get("modified") != source["modified"] or entry.get("projection") != projection
+            if not stale and entry.get("state") == "done" and local_path.exists() \
+                    and local_path.stat().st_size != entry.get("size"):
+                print(f"local changed: {local_path}")
+                local_path.unlink()
+    return source, stale
+
+
+def sync_tables(table_list, dataset_ref, bq_client, gs_bucket, gs_home, local_home,
+                max_jobs=1, download_workers=1, poll_interval=5.0, manifest_path=None, metrics=None,
+                columns=(), event_names=(), temp_dataset_ref=None):
+    # 抽出ジョブを最大max_jobs個まで同時に実行し、終わったものから順にダウンロードする
+    # manifest_pathを指定すると、BigQueryのテーブルが前回から更新されていなければスキップする
+    # metricsを指定すると、テーブルごとの抽出・ダウンロードの秒数と行数・バイト数を記録する
+    # columns・event_namesを指定すると、絞り込むクエリの結果のテーブルを抽出する（クエリと抽出で1つのジョブと数える）
+    # 失敗したテーブルの(テーブル名, 例外)のリストを返す
+    projection = projection_identity(columns, event_names)
+    query_dict = {}
+    error_list = []
+    pending_list = deque(table_list)
+    running_list = []
+    download_list = []
+    manifest = read_manifest(manifest_path)
+    manifest_lock = threading.Lock()
+
+    def record_table(table_name, entry):
+        if manifest_path is None:
+            return
+        with manifest_lock:
+            manifest["partitions"].setdefault(table_name, {})["bq_to_avro"] = entry
+            write_manifest(manifest_path, manifest)
+
+    def download_and_record(table_name, gs_path, local_path, source, extract_seconds):
+        start = time.perf_counter()
+        download_table(gs_bucket, gs_path, local_path)
+        download_seconds = time.perf_counter() - start
+        record_table(table_name, dict(source, state="done", size=local_path.stat().st_size, md5=file_md5(local_path)))
+        if metrics is not None:
+            # 絞り込んだ場合はクエリの結果の行数
+            query_seconds, num_rows = query_dict.get(table_name, (0.0, source.get("num_rows")))
+            if num_rows is None:
+                num_rows = bq_client.get_table(dataset_ref.table(table_name)).num_rows
+            metrics.record(table_name, query_seconds + (extract_seconds or 0) + download_seconds, rows=num_rows,
+                           bytes_out=local_path.stat().st_size, extract_seconds=extract_seconds,
+                           download_seconds=download_seconds, **({"query_seconds": query_seconds} if projection else {}))
+
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        def submit_download(table_name, gs_path, local_path, source, extract_seconds=None):
+            print(f"download:\n    gs://{gs_bucket.name}/{gs_path}\n    -> {local_path}")
+            download_list.append((table_name, executor.submit(
+                download_and_record, table_name, gs_path, local_path, source, extract_seconds)))
+
+        while 0 < len(pending_list) or 0 < len(running_list):
+            # 抽出ジョブを投入する
+            while 0 < len(pending_list) and len(running_list) < max_jobs:
+                table_name = pending_list.popleft()
+                yyyymm = table_name[7:13]
+                file_name = f"{table_name}.avro"
+                local_path = local_home / yyyymm / file_name
+                gs_path = f"{gs_home}/{yyyymm}/{file_name}"
+                gs_fullpath = f"gs://{gs_bucket.name}/{gs_path}"
+
+                # 前回の処理状況
+                source, stale = check_table(table_name, local_path, dataset_ref, bq_client, manifest, manifest_path, projection)
+
+                # localファイル存在チェック
+                if not stale and local_path.exists():
+                    print(f"skip:\n    local exists: {local_path}")
+                    entry = manifest["partitions"].get(table_name, {}).get("bq_to_avro")
+                    if manifest_path is not None and (entry is None or entry.get("state") != "done"):
+                        record_table(table_name, dict(source, state="done", size=local_path.stat().st_size, md5=file_md5(local_path)))
+                    continue
+
+                # GCSファイル存在チェック
+                if not stale and gs_path_exists(gs_bucket, gs_path):
+                    print(f"skip BigQuery:    GCS exists: {gs_path}")
+                    submit_download(table_name, gs_path, local_path, source)
+                    continue
+
+                # BigQuery -> GCS（絞り込む場合は、先にクエリの結果をテーブルに書く）
+                try:
+                    if projection is None:
+                        job = start_bq_to_gs(dataset_ref, table_name, bq_client, gs_fullpath)
+                    else:
+                        job = start_bq_query(dataset_ref, table_name, bq_client, columns, event_names, temp_dataset_ref)
+                except Exception as e:
+                    print(f"error: {table_name}\n    {e}")
+                    error_list.append((table_name, e))
+                    continue
+                if projection is None:
+                    print(f"extract:\n    {table_name}\n    -> {gs_fullpath}")
+                else:
+                    print(f"query:\n    {table_name}\n    columns: {', '.join(columns) or '*'}"
+                          f"\n    event_names: {', '.join(event_names) or '*'}")
+                running_list.append((table_name, gs_path, local_path, source, job, time.perf_counter()))
+
+            # 終わった抽出ジョブのファイルをダウンロードする（GCS -> local）
+            still_running_list = []
+            for table_name, gs_path, local_path, source, job, start in running_list:
+                if not job.done():
+                    still_running_list.append((table_name, gs_path, local_path, source, job, start))
+                    continue
+                try:
+                    job.result()
+                    # 抽出・クエリにかかった秒数はジョブの開始・終了時刻から求める（ポーリング間隔の誤差を含めない）
+                    if job.started is not None and job.ended is not None:
+                        job_seconds = (job.ended - job.started).total_seconds()
+                    else:
+                        job_seconds = time.perf_counter() - start
+                    if job.job_type == "query":
+                        # クエリの結果のテーブルを抽出する（抽出が終わるまで同時に実行するジョブに数える）
+                        query_dict[table_name] = (job_seconds, bq_client.get_table(job.destination).num_rows)
+                        extract_job = bq_client.extract_table(
+                            job.destination, f"gs://{gs_bucket.name}/{gs_path}",
+                            job_config=bigquery.ExtractJobConfig(compression="DEFLATE", destination_format="AVRO"))
+                        print(f"extract:\n    {job.destination.table_id}\n    -> gs://{gs_bucket.name}/{gs_path}")
+                        still_running_list.append((table_name, gs_path, local_path, source, extract_job, time.perf_counter()))
+                        continue
+                    if projection is not None and temp_dataset_ref is not None:
+                        # 抽出が終わったクエリの結果のテーブルは消す
+                        bq_client.delete_table(job.source, not_found_ok=True)
+                except Exception as e:
+                    print(f"error: {table_name}\n    {e}")
+                    error_list.append((table_name, e))
+                else:
+                    record_table(table_name, dict(source, state="extracted"))
+                    submit_download(table_name, gs_path, local_path, source, job_seconds)
+            if 0 < len(still_running_list) and len(still_running_list) == len(running_list):
+                time.sleep(poll_interval)
+            running_list = still_running_list
+
+        for table_name, future in download_list:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"error: {table_name}\n    {e}")
+                error_list.append((table_name, e))
+    if metrics is not None:
+        for _ in error_list:
+            metrics.record_error()
+    return error_list
+
+
+def encode_avro_long(n):
+    # Avroのlong（zigzag可変長整数）
+    n = (n << 1) ^ (n >> 63)
+    data = bytearray()
+    while n & ~0x7F:
+        data.append((n & 0x7F) | 0x80)
+        n >>= 7
+    data.append(n)
+    return bytes(data)
+
+
+def encode_avro_bytes(data):
+    return encode_avro_long(len(data)) + data
+
+
+class AvroBlockWriter:
+    # Storage Read APIが返す行（ヘッダーのない、行のバイナリを連結したもの）を、デコードせずにそのまま
+    # Avroファイル（コーデックはdeflate、抽出ジョブと同じ）のブロックとして書く。複数のスレッドから書いてよい
+    def __init__(self, fo, schema_str):
+        self.fo = fo
+        self.sync_marker = os.urandom(16)
+        self.lock = threading.Lock()
+        meta_list = [("avro.schema", schema_str.encode("utf-8")), ("avro.codec", b"deflate")]
+        header = AVRO_MAGIC + encode_avro_long(len(meta_list))
+        for key, value in meta_list:
+            header += encode_avro_bytes(key.encode("utf-8")) + encode_avro_bytes(value)
+        fo.write(header + encode_avro_long(0) + self.sync_marker)
+
+    def write_block(self, row_count, data):
+        if row_count == 0:
+            return
+        # 圧縮はロックの外で行う（zlibはGILを解放するので、ストリームごとのスレッドで並列に圧縮される）
+        compressor = zlib.compressobj(AVRO_DEFLATE_LEVEL, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        block = encode_avro_long(row_count) + encode_avro_long(len(compressed)) + compressed + self.sync_marker
+        with self.lock:
+            self.fo.write(block)
+
+
+def make_extract_schema(schema_str):
+    # Storage Read APIのAvroスキーマを、抽出ジョブのAvroファイルと同じルートのレコード名（Root）にする
+    # 列の名前・型・NULLABLE/REPEATEDの表し方はどちらもテーブルのスキーマから作られて同じなので、そのままにする
+    # （行のバイナリはスキーマの形に依存するので、型の順番等は変えない）
+    schema = json.loads(schema_str)
+    schema["name"] = "Root"
+    return json.dumps(schema)
+
+
+def quote_bq_string(value):
+    # BigQueryの文字列リテラル
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def read_table_streams(read_client, dataset_ref, table_name, local_path, billing_project, read_streams,
+                       columns=(), event_names=()):
+    # Storage Read APIで1テーブルを最大read_streams本のストリームで並列に読み、Avroファイルに書く。(行数, ストリーム数)を返す
+    # columns・event_namesを指定すると、読む列と行をサーバー側で絞り込む
+    # 一時ファイルに書いてから名前を変える（中断されたファイルを完了と誤認しない）
+    from google.cloud.bigquery_storage import types
+    read_options = types.ReadSession.TableReadOptions(selected_fields=list(columns))
+    if 0 < len(event_names):
+        read_options.row_restriction = f"event_name IN ({', '.join([quote_bq_string(name) for name in event_names])})"
+    read_session = types.ReadSession(
+        table=f"projects/{dataset_ref.project}/datasets/{dataset_ref.dataset_id}/tables/{table_name}",
+        data_format=types.DataFormat.AVRO, read_options=read_options)
+    session = read_client.create_read_session(parent=f"projects/{billing_project}", read_session=read_session,
+                                              max_stream_count=read_streams)
+
+    local_path.parent.mkdir(parents=True, exist_ok=True)    # ディレクトリがなければ作成
+    part_path = local_path.with_name(local_path.name + ".part")
+    with open(part_path, "wb") as fo:
+        writer = AvroBlockWriter(fo, make_extract_schema(session.avro_schema.schema))
+
+        def read_stream(stream):
+            rows = 0
+            for response in read_client.read_rows(stream.name):
+                writer.write_block(response.row_count, response.avro_rows.serialized_binary_rows)
+                rows += response.row_count
+            return rows
+
+        # 空のテーブルはストリームがない（ヘッダーだけのファイルになる）
+        with ThreadPoolExecutor(max_workers=max(1, len(session.streams))) as executor:
+            rows = sum(executor.map(read_stream, session.streams))
+    os.replace(part_path, local_path)
+    return rows, len(session.streams)
+
+
+def read_tables(table_list, dataset_ref, bq_client, read_client, local_home, read_streams=4, manifest_path=None,
+                metrics=None, columns=(), event_names=()):
+    # BigQuery Storage Read APIでテーブルを1つずつ読み、GCSを経由せずにAvroファイルを書く（sync_tables()の代わり）
+    # 差分の判定と処理状況の記録は sync_tables() と同じ。失敗したテーブルの(テーブル名, 例外)のリストを返す
+    projection = projection_identity(columns, event_names)
+    error_list = []
+    manifest = read_manifest(manifest_path)
+    for table_name in table_list:
+        local_path = local_home / table_name[7:13] / f"{table_name}.avro"
+        source, stale = check_table(table_name, local_path, dataset_ref, bq_client, manifest, manifest_path, projection)
+
+        # localファイル存在チェック
+        if not stale and local_path.exists():
+            print(f"skip:\n    local exists: {local_path}")
+            entry = manifest["partitions"].get(table_name, {}).get("bq_to_avro")
+            if manifest_path is not None and (entry is None or entry.get("state") != "done"):
+                manifest["partitions"].setdefault(table_name, {})["bq_to_avro"] = dict(
+                    source, state="done", size=local_path.stat().st_size, md5=file_md5(local_path))
+                write_manifest(manifest_path, manifest)
+            continue
+
+        # BigQuery -> local
+        print(f"read:\n    {table_name}\n    -> {local_path}")
+        start = time.perf_counter()
+        try:
+            rows, streams = read_table_streams(read_client, dataset_ref, table_name, local_path, bq_client.project,
+                                               read_streams, columns, event_names)
+        except Exception as e:
+            print(f"error: {table_name}\n    {e}")
+            error_list.append((table_name, e))
+            continue
+        read_seconds = time.perf_counter() - start
+        print(f"  ... done: {local_path}: {rows} 行, {streams} ストリーム, {read_seconds:.1f} 秒")
+        if manifest_path is not None:
+            manifest["partitions"].setdefault(table_name, {})["bq_to_avro"] = dict(
+                source, state="done", size=local_path.stat().st_size, md5=file_md5(local_path))
+            write_manifest(manifest_path, manifest)
+        if metrics is not None:
+            metrics.record(table_name, read_seconds, rows=rows, bytes_out=local_path.stat().st_size,
+                           read_seconds=read_seconds, streams=streams)
+    if metrics is not None:
+        for _ in error_list:
+            metrics.record_error()
+    return error_list
+
+
 def main():
     config_path = Path.cwd() / "ga4_from_bq_to_avro.ini"
     config = read_config(config_path)
 
+    # 読み込み方法（extract: 抽出ジョブでGCSに書いてからダウンロードする、storage_read: Storage Read APIで直接読む）
+    method = config.get("BigQuery", "method", fallback="extract")
+    if method not in METHODS:
+        raise MyException(f"BigQuery.methodの値が不正です：{method}")
+
     bq_client = bigquery.Client()
-    gs_client = storage.Client()
 
     bq_project = config["BigQuery"]["project"]
     bq_dataset = config["BigQuery"]["dataset"]
-    gs_bucket = gs_client.get_bucket(config["GCS"]["bucket"])
     gs_home = bq_dataset
     local_home = Path.cwd() / bq_dataset
 
@@ -46,32 +499,45 @@ def main():
     table_list.sort(reverse=True)
     print(f"eventsテーブル数：{len(table_list)}")
 
-    for table_name in table_list:
-        yyyymm = table_name[7:13]
-        local_dir = local_home / yyyymm
-        file_name = f"{table_name}.avro"
-        local_path = local_dir / file_name
+    # 同時に実行する抽出ジョブ数と、同時にダウンロードするファイル数
+    max_jobs = config.getint("BigQuery", "max_jobs", fallback=1)
+    download_workers = config.getint("GCS", "download_workers", fallback=1)
 
-        # localファイル存在チェック
-        if local_path.exists():
-            print(f"skip:\n    local exists: {local_path}")
-            continue
+    # 処理状況を記録するファイル（指定がなければ記録しない）
+    manifest_path = None
+    if config.has_option("manifest", "path"):
+        manifest_path = Path.cwd() / config["manifest"]["path"]
 
-        gs_path = f"{gs_home}/{yyyymm}/{file_name}"
-        gs_fullpath = f"gs://{gs_bucket.name}/{gs_path}"
+    # テーブルごとの処理時間・行数・バイト数
+    metrics = open_stage_metrics(config, "bq_to_avro")
 
-        # GCSファイル存在チェック
-        if gs_path_exists(gs_bucket, gs_path):
-            print(f"skip BigQuery:    GCS exists: {gs_path}")
-        else:
-            # BigQuery -> GCS
-            from_bq_to_gs(dataset_ref, table_name, bq_client, gs_fullpath)
+    # 残す列とevent_name（[projection]、指定すると絞り込むクエリの結果を抽出する）
+    columns, event_names = (), ()
+    temp_dataset_ref = None
+    if 0 < len(table_list):
+        columns, event_names = read_projection(config, bq_client.get_table(dataset_ref.table(table_list[0])))
+    if config.get("projection", "temp_dataset", fallback="") != "":
+        temp_dataset_ref = bigquery.DatasetReference(bq_client.project, config["projection"]["temp_dataset"])
 
-        # GCS -> local
-        print(f"download:\n    {gs_fullpath}\n    -> {local_path}")
-        local_dir.mkdir(parents=True, exist_ok=True)    # ディレクトリがなければ作成
-        from_gs_to_local(gs_bucket, gs_path, local_path)
-        print("  ... done.")
+    if method == "storage_read":
+        # Storage Read APIを使うときだけgoogle-cloud-bigquery-storageを読み込む
+        from google.cloud import bigquery_storage
+        read_streams = config.getint("BigQuery", "read_streams", fallback=4)
+        if read_streams < 1:
+            raise MyException(f"BigQuery.read_streamsの値が不正です：{read_streams}")
+        error_list = read_tables(table_list, dataset_ref, bq_client, bigquery_storage.BigQueryReadClient(), local_home,
+                                 read_streams=read_streams, manifest_path=manifest_path, metrics=metrics,
+                                 columns=columns, event_names=event_names)
+    else:
+        gs_bucket = storage.Client().get_bucket(config["GCS"]["bucket"])
+        error_list = sync_tables(table_list, dataset_ref, bq_client, gs_bucket, gs_home, local_home,
+                                 max_jobs=max_jobs, download_workers=download_workers, manifest_path=manifest_path,
+                                 metrics=metrics, columns=columns, event_names=event_names,
+                                 temp_dataset_ref=temp_dataset_ref)
+    metrics.write_prometheus()
+    if 0 < len(error_list):
+        raise MyException(f"失敗したテーブルがあります：{len(error_list)}件\n    " +
+                          "\n    ".join([table_name for table_name, _ in error_list]))
 
 
 if __name__ == "__main__":
@@ -79,3 +545,4 @@ if __name__ == "__main__":
         main()
     except Exception:
         print(traceback.format_exc())
+        sys.exit(1)
@@ -0,0 +1,31 @@
+import sys
+import configparser
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+# google-cloud-bigquery / google-cloud-storage がなければスキップする
+bq_to_avro = pytest.importorskip("ga4_from_bq_to_avro")
+
+TABLE = SimpleNamespace(schema=[SimpleNamespace(name=name) for name in
+                                ("event_date", "event_timestamp", "event_name", "user_id")])
+
+
+def make_config(columns, event_names):
+    config = configparser.ConfigParser()
+    config.read_dict({"projection": {"columns": columns, "event_names": event_names}})
+    return config
+
+
+def test_read_projection_keeps_event_name_when_filtering():
+    # (2)がevent_nameで行を絞り込むので、columnsになくても抽出する
+    columns, event_names = bq_to_avro.read_projection(make_config("user_id", "page_view"), TABLE)
+    assert columns == ("event_date", "event_name", "user_id")
+    assert event_names == ("page_view",)
+
+
+def test_read_projection_without_event_names():
+    columns, event_names = bq_to_avro.read_projection(make_config("user_id", ""), TABLE)
+    assert columns == ("event_date", "user_id")
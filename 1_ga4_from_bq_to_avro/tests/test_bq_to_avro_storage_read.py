@@ -0,0 +1,117 @@
+import io
+import sys
+import json
+from pathlib import Path
+from types import SimpleNamespace
+import fastavro
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent / "2_ga4_from_avro_to_sql" / "deploy"))
+
+# google-cloud-bigquery / google-cloud-bigquery-storage がなければスキップする
+bq_to_avro = pytest.importorskip("ga4_from_bq_to_avro")
+pytest.importorskip("google.cloud.bigquery_storage")
+
+import ga4_from_avro_to_sql as avro_to_sql
+
+
+def make_schema(root_name, device_name, namespace=None):
+    # Storage Read APIと抽出ジョブでは、列は同じでもレコード名等が違う
+    device = {"type": "record", "name": device_name, "fields": [{"name": "category", "type": ["null", "string"]}]}
+    if namespace is not None:
+        device["namespace"] = namespace
+    return {"type": "record", "name": root_name, "fields": [
+        {"name": "event_date", "type": ["null", "string"]},
+        {"name": "event_name", "type": ["null", "string"]},
+        {"name": "device", "type": ["null", device]},
+    ]}
+
+
+READ_SCHEMA = make_schema("__root__", "device", "__root__")
+EXTRACT_SCHEMA = make_schema("Root", "device")
+
+
+def make_row(num):
+    return {"event_date": "20221101", "event_name": ["page_view", "scroll"][num % 2], "device": {"category": f"c{num}"}}
+
+
+def serialize_rows(rec_list):
+    fo = io.BytesIO()
+    parsed_schema = fastavro.parse_schema(READ_SCHEMA)
+    for rec in rec_list:
+        fastavro.schemaless_writer(fo, parsed_schema, rec)
+    return fo.getvalue()
+
+
+class StubReadClient:
+    # ストリームごとに、行を2回に分けて返す
+    def __init__(self, stream_rows_list):
+        self.stream_rows_list = stream_rows_list
+        self.session_args = None
+
+    def create_read_session(self, parent, read_session, max_stream_count):
+        self.session_args = (parent, read_session, max_stream_count)
+        stream_count = min(max_stream_count, len(self.stream_rows_list))
+        return SimpleNamespace(avro_schema=SimpleNamespace(schema=json.dumps(READ_SCHEMA)),
+                               streams=[SimpleNamespace(name=f"stream{num}") for num in range(stream_count)])
+
+    def read_rows(self, stream_name):
+        rec_list = self.stream_rows_list[int(stream_name[len("stream"):])]
+        for chunk in (rec_list[:len(rec_list) // 2], rec_list[len(rec_list) // 2:]):
+            yield SimpleNamespace(row_count=len(chunk), avro_rows=SimpleNamespace(serialized_binary_rows=serialize_rows(chunk)))
+
+
+def test_read_table_streams_writes_deflate_avro(tmp_path):
+    stream_rows_list = [[make_row(num) for num in range(start, start + 50)] for start in (0, 50, 100)]
+    read_client = StubReadClient(stream_rows_list)
+    local_path = tmp_path / "analytics" / "202211" / "events_20221101.avro"
+    dataset_ref = SimpleNamespace(project="proj", dataset_id="analytics")
+
+    rows, streams = bq_to_avro.read_table_streams(read_client, dataset_ref, "events_20221101", local_path, "billing", 3,
+                                                  columns=("event_date", "event_name", "device"),
+                                                  event_names=("page_view", "it's"))
+    assert (rows, streams) == (150, 3)
+    parent, read_session, max_stream_count = read_client.session_args
+    assert (parent, max_stream_count) == ("projects/billing", 3)
+    assert read_session.table == "projects/proj/datasets/analytics/tables/events_20221101"
+    assert list(read_session.read_options.selected_fields) == ["event_date", "event_name", "device"]
+    assert read_session.read_options.row_restriction == "event_name IN ('page_view', 'it\\'s')"
+    assert not local_path.with_name(local_path.name + ".part").exists()
+
+    with open(local_path, "rb") as fi:
+        reader = fastavro.reader(fi)
+        assert reader.codec == "deflate"
+        assert reader.writer_schema["name"] == "Root"
+        rec_list = list(reader)
+    assert sorted(rec_list, key=lambda rec: rec["device"]["category"]) == \
+        sorted(sum(stream_rows_list, []), key=lambda rec: rec["device"]["category"])
+
+
+def test_read_table_streams_empty_table(tmp_path):
+    local_path = tmp_path / "202211" / "events_20221101.avro"
+    rows, streams = bq_to_avro.read_table_streams(StubReadClient([]), SimpleNamespace(project="proj", dataset_id="analytics"),
+                                                  "events_20221101", local_path, "billing", 4)
+    assert (rows, streams) == (0, 0)
+    with open(local_path, "rb") as fi:
+        assert list(fastavro.reader(fi)) == []
+
+
+def test_storage_read_file_converts_with_extract_file(tmp_path):
+    # 新しい日をStorage Read APIで、古い日を抽出ジョブで取り込んだ場合も、(2)はそのまま変換できる
+    read_path = tmp_path / "analytics" / "202211" / "events_20221102.avro"
+    bq_to_avro.read_table_streams(StubReadClient([[make_row(0), make_row(1)]]),
+                                  SimpleNamespace(project="proj", dataset_id="analytics"),
+                                  "events_20221102", read_path, "billing", 1)
+    extract_path = tmp_path / "analytics" / "202211" / "events_20221101.avro"
+    with open(extract_path, "wb") as fo:
+        fastavro.writer(fo, fastavro.parse_schema(EXTRACT_SCHEMA), [make_row(2)], codec="deflate")
+
+    schema_plan = avro_to_sql.make_schema_plan([str(read_path), str(extract_path)], "events")
+    assert schema_plan["reader_schema_dict"] == {}
+    for in_path, rows in ((read_path, 2), (extract_path, 1)):
+        out_path = tmp_path / f"{in_path.stem}.copy"
+        result = avro_to_sql.convert_partition(str(in_path), str(out_path), in_path.stem, schema_plan["schema"],
+                                               schema_plan["postgres_type_list"], "compiled", "copy")
+        assert result["rows"] == rows
+    assert (tmp_path / "events_20221101.copy").read_text(encoding="utf-8") == '20221101\tpage_view\t("c2")\n'
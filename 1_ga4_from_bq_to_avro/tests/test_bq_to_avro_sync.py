@@ -0,0 +1,206 @@
+import sys
+import json
+import datetime
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+# google-cloud-bigquery / google-cloud-storage がなければスキップする
+bq_to_avro = pytest.importorskip("ga4_from_bq_to_avro")
+
+MODIFIED = datetime.datetime(2022, 11, 2, tzinfo=datetime.timezone.utc)
+
+
+class StubDatasetRef:
+    def __init__(self, dataset_id, project="proj"):
+        self.project = project
+        self.dataset_id = dataset_id
+
+    def table(self, table_name):
+        return SimpleNamespace(project=self.project, dataset_id=self.dataset_id, table_id=table_name)
+
+
+class StubBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def exists(self):
+        return self.name in self.bucket.data_dict
+
+    def download_to_filename(self, path):
+        with self.bucket.lock:
+            self.bucket.download_list.append(self.name)
+        Path(path).write_bytes(self.bucket.data_dict[self.name])
+
+
+class StubBucket:
+    def __init__(self, name="bucket"):
+        self.name = name
+        self.data_dict = {}
+        self.download_list = []
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return StubBlob(self, name)
+
+
+class StubJob:
+    # done()をpolls回呼ぶと終わるジョブ。抽出ジョブは終わるとGCSにファイルを書く
+    def __init__(self, client, job_type, polls, gs_uri=None, source=None, destination=None):
+        self.client = client
+        self.job_type = job_type
+        self.polls = polls
+        self.gs_uri = gs_uri
+        self.source = source
+        self.destination = destination
+        self.started = MODIFIED
+        self.ended = MODIFIED + datetime.timedelta(seconds=2)
+        self.finished = False
+
+    def done(self):
+        self.polls -= 1
+        if 0 < self.polls:
+            return False
+        if not self.finished:
+            self.finished = True
+            if self.gs_uri is not None:
+                gs_path = self.gs_uri.split("/", 3)[3]
+                self.client.bucket.data_dict[gs_path] = f"avro:{self.source.table_id}".encode("utf-8")
+        return True
+
+    def result(self):
+        if self.source is not None and self.source.table_id in self.client.fail_set:
+            raise RuntimeError(f"extract failed: {self.source.table_id}")
+        return self
+
+
+class StubBigQueryClient:
+    def __init__(self, bucket, polls=2, fail_set=()):
+        self.project = "proj"
+        self.bucket = bucket
+        self.polls = polls
+        self.fail_set = set(fail_set)
+        self.job_list = []
+        self.query_list = []
+        self.deleted_list = []
+        self.max_running = 0
+
+    def add_job(self, job):
+        self.job_list.append(job)
+        self.max_running = max(self.max_running, len([job for job in self.job_list if not job.finished]))
+        return job
+
+    def get_table(self, table_ref):
+        return SimpleNamespace(modified=MODIFIED, num_rows=7 if table_ref.dataset_id == "tmp" else 10)
+
+    def extract_table(self, table_ref, gs_uri, job_config=None):
+        return self.add_job(StubJob(self, "extract", self.polls, gs_uri=gs_uri, source=table_ref))
+
+    def query(self, query, job_config=None):
+        self.query_list.append((query, job_config))
+        return self.add_job(StubJob(self, "query", self.polls, destination=job_config.destination))
+
+    def delete_table(self, table_ref, not_found_ok=False):
+        self.deleted_list.append(table_ref.table_id)
+
+
+def read_manifest_partitions(manifest_path):
+    return {name: entry["bq_to_avro"] for name, entry in json.loads(manifest_path.read_text(encoding="utf-8"))["partitions"].items()}
+
+
+def test_sync_tables_skips_extracts_and_downloads(tmp_path):
+    bucket = StubBucket()
+    bq_client = StubBigQueryClient(bucket, polls=3)
+    local_home = tmp_path / "analytics"
+    manifest_path = tmp_path / "ga4_manifest.json"
+    metrics = bq_to_avro.StageMetrics("bq_to_avro")
+    # ローカルにあるテーブルと、GCSにだけあるテーブル
+    local_path = local_home / "202211" / "events_20221104.avro"
+    local_path.parent.mkdir(parents=True)
+    local_path.write_bytes(b"local")
+    bucket.data_dict["analytics/202211/events_20221103.avro"] = b"gcs"
+    table_list = ["events_20221104", "events_20221103", "events_20221102", "events_20221101", "events_20221031"]
+
+    error_list = bq_to_avro.sync_tables(table_list, StubDatasetRef("analytics"), bq_client, bucket, "analytics", local_home,
+                                        max_jobs=2, download_workers=2, poll_interval=0, manifest_path=manifest_path,
+                                        metrics=metrics)
+    assert error_list == []
+    # 抽出ジョブは存在しないテーブルだけ、同時にmax_jobs個まで
+    assert sorted([job.source.table_id for job in bq_client.job_list]) == ["events_20221031", "events_20221101", "events_20221102"]
+    assert bq_client.max_running == 2
+    assert local_path.read_bytes() == b"local"
+    assert (local_home / "202211" / "events_20221103.avro").read_bytes() == b"gcs"
+    for table_name in ("events_20221102", "events_20221101"):
+        assert (local_home / "202211" / f"{table_name}.avro").read_bytes() == f"avro:{table_name}".encode("utf-8")
+    assert (local_home / "202210" / "events_20221031.avro").exists()
+    assert sorted(bucket.download_list) == ["analytics/202210/events_20221031.avro", "analytics/202211/events_20221101.avro",
+                                            "analytics/202211/events_20221102.avro", "analytics/202211/events_20221103.avro"]
+    assert list(local_home.glob("*/*.part")) == []
+
+    # 並列のダウンロードから書いた処理状況が、すべてのテーブルについて残る
+    partitions = read_manifest_partitions(manifest_path)
+    assert sorted(partitions) == sorted(table_list)
+    for table_name, entry in partitions.items():
+        path = local_home / table_name[7:13] / f"{table_name}.avro"
+        assert entry["state"] == "done"
+        assert entry["modified"] == MODIFIED.isoformat()
+        assert entry["size"] == path.stat().st_size
+        assert entry["md5"] == bq_to_avro.file_md5(path)
+    record_dict = {record["partition"]: record for record in metrics.record_list}
+    assert sorted(record_dict) == sorted(table_list[1:])
+    assert record_dict["events_20221102"]["extract_seconds"] == 2.0
+    assert record_dict["events_20221103"]["extract_seconds"] is None
+
+    # 2回目はBigQueryのテーブルが変わっていないので、何もしない
+    bq_client.job_list = []
+    error_list = bq_to_avro.sync_tables(table_list, StubDatasetRef("analytics"), bq_client, bucket, "analytics", local_home,
+                                        max_jobs=2, poll_interval=0, manifest_path=manifest_path)
+    assert error_list == []
+    assert bq_client.job_list == []
+
+
+def test_sync_tables_queries_before_extract(tmp_path):
+    bucket = StubBucket()
+    bq_client = StubBigQueryClient(bucket)
+    local_home = tmp_path / "analytics"
+    metrics = bq_to_avro.StageMetrics("bq_to_avro")
+
+    error_list = bq_to_avro.sync_tables(["events_20221102", "events_20221101"], StubDatasetRef("analytics"), bq_client,
+                                        bucket, "analytics", local_home, max_jobs=1, poll_interval=0, metrics=metrics,
+                                        columns=("event_date", "event_name"), event_names=("page_view",),
+                                        temp_dataset_ref=StubDatasetRef("tmp"))
+    assert error_list == []
+    query, job_config = bq_client.query_list[0]
+    assert query == ("SELECT `event_date`, `event_name` FROM `proj.analytics.events_20221102`"
+                     " WHERE event_name IN UNNEST(@event_names)")
+    assert job_config.destination.table_id == "events_20221102"
+    # クエリの結果のテーブルを抽出し、抽出が終わったら消す
+    assert [(job.job_type, (job.source or job.destination).dataset_id) for job in bq_client.job_list] == \
+        [("query", "tmp"), ("extract", "tmp"), ("query", "tmp"), ("extract", "tmp")]
+    assert bq_client.max_running == 1
+    assert sorted(bq_client.deleted_list) == ["events_20221101", "events_20221102"]
+    assert (local_home / "202211" / "events_20221102.avro").read_bytes() == b"avro:events_20221102"
+    record = metrics.record_list[0]
+    assert (record["rows"], record["query_seconds"], record["extract_seconds"]) == (7, 2.0, 2.0)
+
+
+def test_sync_tables_reports_failed_jobs(tmp_path):
+    bucket = StubBucket()
+    bq_client = StubBigQueryClient(bucket, fail_set=["events_20221101"])
+    local_home = tmp_path / "analytics"
+    manifest_path = tmp_path / "ga4_manifest.json"
+    metrics = bq_to_avro.StageMetrics("bq_to_avro")
+
+    error_list = bq_to_avro.sync_tables(["events_20221102", "events_20221101"], StubDatasetRef("analytics"), bq_client,
+                                        bucket, "analytics", local_home, max_jobs=2, poll_interval=0,
+                                        manifest_path=manifest_path, metrics=metrics)
+    assert [table_name for table_name, _ in error_list] == ["events_20221101"]
+    assert metrics.error_count == 1
+    assert not (local_home / "202211" / "events_20221101.avro").exists()
+    partitions = read_manifest_partitions(manifest_path)
+    assert partitions["events_20221102"]["state"] == "done"
+    assert "events_20221101" not in partitions
@@ -0,0 +1,140 @@
+import sys
+import time
+import traceback
+from pathlib import Path
+import queue
+import multiprocessing
+import psycopg2
+from ga4_from_avro_to_sql import MyException, MyReader, read_config, list_avro_sources, open_avro_source, \
+    avro_source_identity, open_stage_metrics, read_projection, make_schema_plan, make_sql_ddl, compile_copy_row
+
+
+class QueueReader:
+    # copy_expert()に渡すファイル風オブジェクト。変換プロセスがキューに入れたCOPYデータを順に返す
+    def __init__(self, row_queue, producer):
+        self.row_queue = row_queue
+        self.producer = producer
+
+    def read(self, size=-1):
+        while True:
+            try:
+                chunk = self.row_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.producer.is_alive():
+                    raise MyException(f"変換プロセスが異常終了しました：exitcode={self.producer.exitcode}")
+        if chunk is None:
+            return ""
+        if type(chunk) is MyException:
+            raise chunk
+        return chunk
+
+
+def produce_rows(in_path_str, schema, postgres_type_list, row_queue, chunk_rows, read_ahead, event_names=(),
+                 reader_schema=None):
+    # Avroファイルを読み、COPYデータをchunk_rows行ずつキューに入れる（終了時はNone）
+    # event_namesを指定すると、それ以外のevent_nameの行を除く
+    # reader_schemaを指定すると、そのスキーマで読む（列が追加される前の古いファイル）
+    try:
+        make_row = compile_copy_row(schema, postgres_type_list, null_if_convert_error=False)
+        event_name_set = frozenset(event_names)
+        with open_avro_source(in_path_str, read_ahead) as fi:
+            reader = MyReader(fi, reader_schema)
+            row_list = []
+            for rec in reader:
+                if 0 < len(event_name_set) and rec["event_name"] not in event_name_set:
+                    continue
+                row_list.append(make_row(rec))
+                if chunk_rows <= len(row_list):
+                    row_queue.put("".join(row_list))
+                    row_list = []
+            if 0 < len(row_list):
+                row_queue.put("".join(row_list))
+        row_queue.put(None)
+    except Exception:
+        row_queue.put(MyException(f"変換に失敗しました：{in_path_str}\n{traceback.format_exc()}"))
+
+
+def load_partition(conn, in_path_str, schema_plan, queue_size, chunk_rows, read_ahead, event_names=()):
+    # 変換プロセスでAvroを読みながら、このプロセスでCOPYを送信する
+    table_name = Path(in_path_str).stem.lower()
+    row_queue = multiprocessing.Queue(maxsize=queue_size)
+    producer = multiprocessing.Process(
+        target=produce_rows,
+        args=(in_path_str, schema_plan["schema"], schema_plan["postgres_type_list"], row_queue, chunk_rows, read_ahead,
+              event_names, schema_plan["reader_schema_dict"].get(in_path_str)))
+    producer.start()
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY {table_name} FROM STDIN", QueueReader(row_queue, producer))
+            rows = cur.rowcount
+        conn.commit()
+    finally:
+        if producer.is_alive():
+            producer.terminate()
+        producer.join()
+    return rows
+
+
+def main():
+    config_path = Path.cwd() / "ga4_from_avro_to_postgres.ini"
+    config = read_config(config_path)
+    avro_list = list_avro_sources(config)
+    print(f"Avroファイル数：{len(avro_list)}")
+    if len(avro_list) == 0:
+        return
+
+    avro_list.sort(reverse=True)
+    postgres_record_type_prefix = "events"
+
+    # キューに溜めるチャンク数と、1チャンクの行数
+    queue_size = config.getint("pipeline", "queue_size", fallback=16)
+    chunk_rows = config.getint("pipeline", "chunk_rows", fallback=1000)
+
+    # GCSから直接読む場合の先読みの単位(MB)と個数
+    read_ahead = (config.getint("GCS", "read_ahead_mb", fallback=8) * 1024 * 1024,
+                  config.getint("GCS", "read_ahead_chunks", fallback=4))
+
+    host = config["postgresql"]["host"]
+    port = config["postgresql"]["port"]
+    dbname = config["postgresql"]["dbname"]
+    user = config["postgresql"]["user"]
+    password = config["postgresql"]["password"]
+
+    # パーティションごとの処理時間・行数・バイト数
+    metrics = open_stage_metrics(config, "avro_to_postgres")
+
+    # 残す列とevent_name（[projection]）
+    columns, event_names = read_projection(config)
+    schema_plan = make_schema_plan(avro_list, postgres_record_type_prefix, columns=columns)
+
+    with psycopg2.connect(f"host={host} port={port} dbname={dbname} user={user} password={password}") as conn:
+        with conn.cursor() as cur:
+            print(f"DDLを実行します")
+            cur.execute(make_sql_ddl(schema_plan))
+            print("  ... done.")
+        conn.commit()
+
+        print(f"COPYを実行します")
+        try:
+            for index, in_path_str in enumerate(avro_list, 1):
+                start = time.perf_counter()
+                rows = load_partition(conn, in_path_str, schema_plan, queue_size, chunk_rows, read_ahead, event_names)
+                seconds = time.perf_counter() - start
+                print(f"({index}) パーティション: {Path(in_path_str).stem.lower()}: {rows} 行, {seconds:.1f} 秒")
+                metrics.record(Path(in_path_str).stem.lower(), seconds, rows=rows,
+                               bytes_in=avro_source_identity(in_path_str)["size"])
+        except Exception:
+            metrics.record_error()
+            raise
+        finally:
+            metrics.write_prometheus()
+    conn.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        print(traceback.format_exc())
+        sys.exit(1)
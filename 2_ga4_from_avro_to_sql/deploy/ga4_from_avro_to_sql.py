@@ -1,17 +1,44 @@
 import datetime
+import sys
+import os
+import time
+import signal
+import re
+import hashlib
 import traceback
+import io
+import queue
+import threading
+import shutil
+import gzip
 import json
-import datetime
+import copy
 from pathlib import Path
 import glob
 import configparser
 import textwrap
+import functools
+import contextlib
+import cProfile
 import fastavro
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from psycopg2.extensions import adapt
 
 COMMIT_NUM = 100
 DT_UTC_AWARE = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+ISOFORMAT_LOGICAL_TYPES = ("timestamp-millis", "timestamp-micros", "date", "time-millis", "time-micros",
+                           "local-timestamp-millis", "local-timestamp-micros")
+OUTPUT_SUFFIX = {"insert": ".sql", "copy": ".copy", "prepared": ".prep"}
+COMPRESSION_SUFFIX = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+COMPRESSION_LEVEL = {"gzip": (1, 9, 6), "zstd": (1, 22, 3)}
+PARTITION_HEAD = {"insert": "BEGIN;\n", "copy": "", "prepared": ""}
+PARTITION_TAIL = {"insert": "COMMIT;\n", "copy": "", "prepared": ""}
+SYNC_SIZE = 16
+ESCAPE_CACHE_SIZE = 65536
+GS_HEADER_CHUNK_SIZE = 256 * 1024
+SCHEMA_CACHE_NAME = "ga4_schema_cache.json"
+NORMALIZE_FIELDS = ("event_params", "user_properties", "items")
 
 
 class MyException(Exception):
@@ -19,21 +46,299 @@ class MyException(Exception):
 
 
 class MyReader(fastavro.reader):
-    def __init__(self, file):
-        super().__init__(file)
+    def __init__(self, file, reader_schema=None):
+        super().__init__(file, reader_schema=reader_schema)
         self.meta = self._header["meta"]
 
 
+class ReadAheadReader(io.RawIOBase):
+    # 別スレッドでrawからchunk_sizeバイトずつ、最大depth個まで先読みする（GCSからのダウンロードと変換を並行させる）
+    def __init__(self, raw, chunk_size, depth):
+        super().__init__()
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.chunk_queue = queue.Queue(maxsize=depth)
+        self.buffer = memoryview(b"")
+        self.eof = False
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stopped:
+                data = self.raw.read(self.chunk_size)
+                self.chunk_queue.put(data)
+                if len(data) == 0:
+                    break
+        except Exception as e:
+            self.chunk_queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.buffer) == 0:
+            if self.error is not None:
+                # 先読みスレッドは終わっているので、キューを待たずに同じ例外を返す
+                raise self.error
+            if self.eof:
+                return 0
+            data = self.chunk_queue.get()
+            if isinstance(data, Exception):
+                self.error = data
+                raise data
+            if len(data) == 0:
+                self.eof = True
+                return 0
+            self.buffer = memoryview(data)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            # 先読みスレッドがキューの空きを待っていれば解放する
+            self.stopped = True
+            while self.thread.is_alive():
+                try:
+                    self.chunk_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.raw.close()
+        super().close()
+
+
 def read_config(config_path):
     config = configparser.ConfigParser()
     config.read(config_path, encoding="utf-8")
     return config
 
 
-def escape(ss):
+# GCSのバケット（(プロセスID, バケット名)ごと）と、一覧を取得したときのAvroファイルの大きさ・更新日時
+gs_bucket_dict = {}
+gs_source_identity_dict = {}
+
+
+def open_gs_bucket(bucket_name):
+    # GCSを使うときだけgoogle-cloud-storageを読み込む
+    # クライアントはプロセスごとに1つだけ作って使い回す（forkした子プロセスでは親の接続を使わない）
+    key = (os.getpid(), bucket_name)
+    if key not in gs_bucket_dict:
+        from google.cloud import storage
+        gs_bucket_dict[key] = storage.Client().bucket(bucket_name)
+    return gs_bucket_dict[key]
+
+
+def list_avro_sources(config):
+    # 変換するAvroファイルのリスト（ローカルのパス、または gs://バケット/プレフィックス/yyyymm/events_*.avro）
+    source = config.get("convert", "source", fallback="local")
+    if source == "local":
+        local_in_home = Path.cwd() / config["local"]["avro_home"]
+        return glob.glob(str(local_in_home) + "/*/events_*.avro")
+    elif source == "gcs":
+        bucket_name = config["GCS"]["bucket"]
+        prefix = config["GCS"]["prefix"].strip("/") + "/"
+        avro_list = []
+        for blob in open_gs_bucket(bucket_name).list_blobs(prefix=prefix):
+            name_list = blob.name[len(prefix):].split("/")
+            if len(name_list) == 2 and name_list[1].startswith("events_") and name_list[1].endswith(".avro"):
+                in_path_str = f"gs://{bucket_name}/{blob.name}"
+                avro_list.append(in_path_str)
+                # 一覧の結果に大きさ・更新日時が含まれるので、ファイルごとに取得し直さない
+                gs_source_identity_dict[in_path_str] = {"size": blob.size, "updated": blob.updated.isoformat()}
+        return avro_list
+    else:
+        raise MyException(f"convert.sourceの値が不正です：{source}")
+
+
+def open_avro_source(in_path_str, read_ahead=None):
+    # Avroファイルをバイナリモードで開く。GCSの場合はread_ahead=(chunk_size, depth)で先読みする
+    if not in_path_str.startswith("gs://"):
+        return open(in_path_str, "rb")
+
+    bucket_name, blob_name = in_path_str[len("gs://"):].split("/", 1)
+    blob = open_gs_bucket(bucket_name).blob(blob_name)
+    if read_ahead is None:
+        # ヘッダーを読むだけなら小さな単位で取得する
+        return blob.open("rb", chunk_size=GS_HEADER_CHUNK_SIZE)
+    chunk_size, depth = read_ahead
+    return io.BufferedReader(ReadAheadReader(blob.open("rb", chunk_size=chunk_size), chunk_size, depth))
+
+
+def avro_source_identity(in_path_str):
+    # 前回の変換時から変わったかどうかを判定するための、Avroファイルの大きさと更新日時
+    if in_path_str.startswith("gs://"):
+        if in_path_str in gs_source_identity_dict:
+            return gs_source_identity_dict[in_path_str]
+        bucket_name, blob_name = in_path_str[len("gs://"):].split("/", 1)
+        blob = open_gs_bucket(bucket_name).get_blob(blob_name)
+        return {"size": blob.size, "updated": blob.updated.isoformat()}
+    stat = os.stat(in_path_str)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_manifest(manifest_path):
+    # 3つのステージで共有する、パーティションごとの処理状況
+    if manifest_path is None or not manifest_path.exists():
+        return {"partitions": {}}
+    with open(manifest_path, "rt", encoding="utf-8") as fi:
+        return json.load(fi)
+
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, "wt", encoding="utf-8") as fo:
+        json.dump(manifest, fo, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+class StageMetrics:
+    # パーティションごとの処理時間・行数・バイト数を、JSON Lines と Prometheus の textfile に書き出す
+    # （どちらもパスの指定がなければ書き出さない）
+    def __init__(self, stage, jsonl_path=None, prometheus_path=None):
+        self.stage = stage
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.record_list = []
+        self.error_count = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, partition, seconds, rows=None, bytes_in=None, bytes_out=None, **extra):
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "stage": self.stage,
+            "partition": partition,
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "rows_per_sec": round(rows / seconds, 1) if rows is not None and 0 < seconds else None,
+        }
+        record.update({key: round(value, 3) if type(value) is float else value for key, value in extra.items()})
+        with self.lock:
+            self.record_list.append(record)
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, "at", encoding="utf-8") as fo:
+                    fo.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def record_error(self):
+        with self.lock:
+            self.error_count += 1
+
+    def write_prometheus(self):
+        # node_exporterのtextfileコレクターが書きかけのファイルを読まないように、一時ファイルから名前を変える
+        if self.prometheus_path is None:
+            return
+        # 同じパーティションを複数回記録した場合は最後の値を使う
+        latest_dict = {record["partition"]: record for record in self.record_list}
+        value_dict = {}
+        for record in latest_dict.values():
+            for key, value in record.items():
+                if key not in ("time", "stage", "partition") and type(value) in (int, float):
+                    value_dict.setdefault(key, []).append((record["partition"], value))
+        lines = []
+        for key, value_list in value_dict.items():
+            name = f"ga4_partition_{key.replace('_per_sec', '_per_second')}"
+            lines.append(f"# TYPE {name} gauge\n")
+            for partition, value in value_list:
+                lines.append(f'{name}{{stage="{self.stage}",partition="{partition}"}} {value}\n')
+        for name, value in (("ga4_stage_partitions", len(latest_dict)),
+                            ("ga4_stage_errors", self.error_count),
+                            ("ga4_stage_rows", sum([record["rows"] or 0 for record in latest_dict.values()])),
+                            ("ga4_stage_seconds", round(time.time() - self.start, 3)),
+                            ("ga4_stage_last_run_timestamp_seconds", round(time.time(), 3))):
+            lines.append(f"# TYPE {name} gauge\n")
+            lines.append(f'{name}{{stage="{self.stage}"}} {value}\n')
+        tmp_path = self.prometheus_path.with_name(self.prometheus_path.name + ".tmp")
+        with open(tmp_path, "wt", encoding="utf-8") as fo:
+            fo.writelines(lines)
+        os.replace(tmp_path, self.prometheus_path)
+
+
+def open_stage_metrics(config, stage):
+    # [metrics] jsonl_path / prometheus_path（指定がなければ書き出さない）
+    path_list = []
+    for key in ("jsonl_path", "prometheus_path"):
+        path_str = config.get("metrics", key, fallback="")
+        path_list.append(Path.cwd() / path_str if path_str != "" else None)
+    return StageMetrics(stage, *path_list)
+
+
+def escape_uncached(ss):
+    # シングルクォート・バックスラッシュ・NULを含まなければ、adapt()の結果は前後をクォートで囲んだだけになる
+    if "'" not in ss and "\\" not in ss and "\x00" not in ss:
+        return "'" + ss + "'"
     return str(adapt(ss.encode("utf-8").decode("latin-1")))
 
 
+def copy_escape_uncached(text):
+    # COPYテキスト形式のエスケープ。ほとんどの文字列はエスケープする文字を含まないので、そのまま返す
+    if "\\" not in text and "\t" not in text and "\n" not in text and "\r" not in text:
+        return text
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def escape_copy_element(text):
+    # 配列要素・複合型フィールドの中の \ と " をエスケープする
+    if "\\" not in text and '"' not in text:
+        return text
+    return text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def copy_element_quote(depth):
+    # 入れ子の深さdepthの要素を囲むダブルクォート（外側の要素のエスケープを済ませたもの）
+    quote = '"'
+    for _ in range(depth):
+        quote = escape_copy_element(quote)
+    return quote
+
+
+def quote_copy_element_uncached(text, depth=0):
+    # 配列要素・複合型フィールドは常にダブルクォートで囲む。
+    # 入れ子の要素は、外側の要素でエスケープされた形（depth回多くエスケープ）を直接作る
+    quote = copy_element_quote(depth)
+    for _ in range(depth + 1):
+        text = escape_copy_element(text)
+    return quote + text + quote
+
+
+# GA4の文字列（event_name、event_params.key、geo.*、device.*など）は種類が少ないので、結果をキャッシュする
+# （COPYの値の文字列・配列要素も同じ）
+escape = functools.lru_cache(maxsize=ESCAPE_CACHE_SIZE)(escape_uncached)
+copy_escape = functools.lru_cache(maxsize=ESCAPE_CACHE_SIZE)(copy_escape_uncached)
+quote_copy_element = functools.lru_cache(maxsize=ESCAPE_CACHE_SIZE)(quote_copy_element_uncached)
+
+
+def set_escape_cache_size(maxsize):
+    # 変換関数を組み立てる前に呼ぶ（0: キャッシュしない）
+    global escape, copy_escape, quote_copy_element
+    if 0 < maxsize:
+        escape = functools.lru_cache(maxsize=maxsize)(escape_uncached)
+        copy_escape = functools.lru_cache(maxsize=maxsize)(copy_escape_uncached)
+        quote_copy_element = functools.lru_cache(maxsize=maxsize)(quote_copy_element_uncached)
+    else:
+        escape = escape_uncached
+        copy_escape = copy_escape_uncached
+        quote_copy_element = quote_copy_element_uncached
+
+
+def escape_cache_counts():
+    # (ヒット数, ミス数)。INSERT文のescape()とCOPYのエスケープの合計
+    hits = 0
+    misses = 0
+    for cached in (escape, copy_escape, quote_copy_element):
+        if cached in (escape_uncached, copy_escape_uncached, quote_copy_element_uncached):
+            continue
+        cache_info = cached.cache_info()
+        hits += cache_info.hits
+        misses += cache_info.misses
+    return hits, misses
+
+
 def convert_to_postgres_type(avro_type, default_value, ddl_queue, postgres_record_type_prefix, len_is_serial_of_postgres_record_type):
     postgres_type = None
     default_str = None
@@ -130,6 +435,16 @@ def convert_to_postgres_type(avro_type, default_value, ddl_queue, postgres_recor
     return postgres_type, default_str, nullable
 
 
+def postgres_type_name(postgres_type):
+    # convert_to_postgres_type()が返す型の、CREATE TYPE／CREATE TABLEに書く型名
+    if type(postgres_type) is str:
+        return postgres_type
+    elif "record" in postgres_type:
+        return postgres_type["record"]
+    else:
+        return postgres_type["array"]
+
+
 def make_sql_create_type(name, avro_fields, ddl_queue, postgres_record_type_prefix, len_is_serial_of_postgres_record_type):
     ddl_stmt = ""
     postgres_fields_type = []
@@ -142,13 +457,7 @@ def make_sql_create_type(name, avro_fields, ddl_queue, postgres_record_type_pref
             ddl_stmt = f"CREATE TYPE {name} AS (\n    "
         else:
             ddl_stmt += "\n  , "
-        ddl_stmt += field["name"] + ' '
-        if type(postgres_type) is str:
-            ddl_stmt += postgres_type
-        elif "record" in postgres_type:
-            ddl_stmt += postgres_type["record"]
-        else:
-            ddl_stmt += postgres_type["array"]
+        ddl_stmt += field["name"] + ' ' + postgres_type_name(postgres_type)
     if 0 < len(ddl_stmt):
         ddl_stmt += "\n);\n"
         ddl_queue.append(ddl_stmt)
@@ -171,13 +480,7 @@ def make_sql_create_table(name, avro_fields, ddl_queue, postgres_record_type_pre
             ddl_stmt = f"    "
         else:
             ddl_stmt += "\n  , "
-        ddl_stmt += field["name"] + ' '
-        if type(postgres_type) is str:
-            ddl_stmt += postgres_type
-        elif "record" in postgres_type:
-            ddl_stmt += postgres_type["record"]
-        else:
-            ddl_stmt += postgres_type["array"]
+        ddl_stmt += field["name"] + ' ' + postgres_type_name(postgres_type)
         if not nullable:
             ddl_stmt += " NOT NULL"
         if "default" in field:
@@ -285,13 +588,1017 @@ def make_sql_insert(tablename, schema, postgres_type_list, rec, null_if_convert_
     return insert_stmt
 
 
+def strip_null_type(avro_type):
+    if type(avro_type) is list:
+        avro_type = [t for t in avro_type if t != "null"]
+        assert len(avro_type) == 1
+        avro_type = avro_type[0]
+    return avro_type
+
+
+def compile_null_handling(convert, null_value, null_if_convert_error):
+    if null_if_convert_error:
+        def convert_value(avro_value):
+            if avro_value is None:
+                return null_value
+            try:
+                return convert(avro_value)
+            except Exception:
+                return null_value
+    else:
+        def convert_value(avro_value):
+            if avro_value is None:
+                return null_value
+            return convert(avro_value)
+    return convert_value
+
+
+def compile_convert_error(avro_type):
+    def convert(avro_value):
+        raise MyException(f"Convert Error: type={avro_type}, value={avro_value}")
+    return convert
+
+
+def compile_to_postgres_value(avro_type, postgres_type, null_if_convert_error):
+    # convert_to_postgres_value()と同じ変換を、スキーマから1回だけ組み立てた関数で行う
+    avro_type = strip_null_type(avro_type)
+
+    convert = None
+    if type(avro_type) is str:
+        if avro_type == "string":
+            convert = escape
+        elif avro_type in ("long", "double"):
+            convert = str
+        elif avro_type == "boolean":
+            convert = convert_boolean_to_postgres_value
+    elif type(avro_type) is dict:
+        if "sqlType" in avro_type:
+            if avro_type["sqlType"] == "JSON":
+                convert = escape
+        elif "logicalType" in avro_type:
+            logical_type = avro_type["logicalType"]
+            if logical_type == "decimal":
+                convert = str
+            elif logical_type in ISOFORMAT_LOGICAL_TYPES:
+                convert = convert_isoformat_to_postgres_value
+        else:
+            avro_child_type = avro_type["type"]
+            if avro_child_type == "array":
+                convert_items = compile_to_postgres_value(
+                    avro_type["items"], postgres_type["items"], null_if_convert_error)
+                postgres_array_type = postgres_type["array"]
+
+                def convert(avro_value):
+                    return f'ARRAY[{",".join([convert_items(val) for val in avro_value])}]::{postgres_array_type}'
+            elif avro_child_type == "record":
+                convert_fields = [
+                    (avro_field["name"], compile_to_postgres_value(avro_field["type"], postgres_field_type, null_if_convert_error))
+                    for avro_field, postgres_field_type in zip(avro_type["fields"], postgres_type["fields"])]
+
+                def convert(avro_value):
+                    return f'ROW({",".join([convert_field(avro_value[name]) for name, convert_field in convert_fields])})'
+
+    if convert is None:
+        convert = compile_convert_error(avro_type)
+    return compile_null_handling(convert, "NULL", null_if_convert_error)
+
+
+def convert_boolean_to_postgres_value(avro_value):
+    return "TRUE" if avro_value else "FALSE"
+
+
+def convert_isoformat_to_postgres_value(avro_value):
+    return escape(avro_value.isoformat())
+
+
+def convert_eventtimestamp_to_postgres_value(avro_value):
+    return escape((DT_UTC_AWARE + datetime.timedelta(microseconds=avro_value)).isoformat())
+
+
+def compile_sql_insert_values(tablename, schema, postgres_type_list, null_if_convert_error=False):
+    # INSERT文の「VALUES 」までと、1行分の「(値, ...)」を出力する関数を返す（複数行のINSERT文を組み立てる）
+    insert_into = []
+    convert_list = []
+
+    for field, postgres_type in zip(schema["fields"], postgres_type_list):
+        field_name = field["name"]
+        insert_into.append(field_name)
+        convert_list.append((field_name, compile_to_postgres_value(field["type"], postgres_type, null_if_convert_error)))
+
+        if field_name == "event_timestamp":
+            insert_into.append("eventtimestamp")
+            convert_list.append((field_name, convert_eventtimestamp_to_postgres_value))
+
+    insert_into_str = "\n  , ".join(insert_into)
+    insert_head = f"INSERT INTO {tablename} (\n    {insert_into_str}\n)\nVALUES "
+
+    def make_values(rec):
+        insert_values_str = "\n  , ".join([convert(rec[field_name]) for field_name, convert in convert_list])
+        return f"(\n    {insert_values_str}\n)"
+    return insert_head, make_values
+
+
+def compile_sql_insert(tablename, schema, postgres_type_list, null_if_convert_error=False):
+    # make_sql_insert()と同じINSERT文を出力する関数を返す（行ごとの型判定を行わない）
+    insert_head, make_values = compile_sql_insert_values(tablename, schema, postgres_type_list, null_if_convert_error)
+
+    def make_insert(rec):
+        return f"{insert_head}{make_values(rec)};\n"
+    return make_insert
+
+
+def compile_to_copy_value(avro_type, postgres_type, null_if_convert_error):
+    # COPYテキスト形式の1値（エスケープ前）を返す関数を組み立てる。NULLはNoneを返す
+    avro_type = strip_null_type(avro_type)
+
+    convert = None
+    if type(avro_type) is str:
+        if avro_type == "string":
+            convert = str
+        elif avro_type in ("long", "double"):
+            convert = str
+        elif avro_type == "boolean":
+            convert = convert_boolean_to_copy_value
+    elif type(avro_type) is dict:
+        if "sqlType" in avro_type:
+            if avro_type["sqlType"] == "JSON":
+                convert = str
+        elif "logicalType" in avro_type:
+            logical_type = avro_type["logicalType"]
+            if logical_type == "decimal":
+                convert = str
+            elif logical_type in ISOFORMAT_LOGICAL_TYPES:
+                convert = convert_isoformat_to_copy_value
+        else:
+            convert = compile_copy_composite(avro_type, postgres_type, null_if_convert_error, 0)
+
+    if convert is None:
+        convert = compile_convert_error(avro_type)
+    return compile_null_handling(convert, None, null_if_convert_error)
+
+
+def compile_copy_composite(avro_type, postgres_type, null_if_convert_error, depth):
+    # 配列・レコード（NULLでない値）を「{...}」「(...)」の文字列にする関数を返す（配列・レコードでなければNone）。
+    # depthは要素の入れ子の深さ（列の値そのものは0）
+    avro_child_type = avro_type["type"]
+    if avro_child_type == "array":
+        convert_item = compile_copy_element(avro_type["items"], postgres_type["items"], null_if_convert_error, depth)
+
+        def convert(avro_value):
+            return "{" + ",".join(["NULL" if val is None or (text := convert_item(val)) is None else text
+                                   for val in avro_value]) + "}"
+        return convert
+    if avro_child_type == "record":
+        convert_fields = [
+            (avro_field["name"], compile_copy_element(avro_field["type"], postgres_field_type, null_if_convert_error, depth))
+            for avro_field, postgres_field_type in zip(avro_type["fields"], postgres_type["fields"])]
+
+        def convert(avro_value):
+            return "(" + ",".join(["" if (val := avro_value[name]) is None or (text := convert_field(val)) is None else text
+                                   for name, convert_field in convert_fields]) + ")"
+        return convert
+    return None
+
+
+def compile_copy_element(avro_type, postgres_type, null_if_convert_error, depth):
+    # 配列要素・複合型フィールドの1値（NULLでない値）を、ダブルクォートで囲んだ文字列にする関数を返す
+    # （変換できずにNULLにする場合はNone）。要素ごとに関数を重ねて呼ばないように、よく使う型は直接変換する
+    avro_type = strip_null_type(avro_type)
+    quote = copy_element_quote(depth)
+    if avro_type == "string" and not null_if_convert_error:
+        # 文字列は種類が少ないので、クォートした結果をキャッシュする
+        cached_quote = quote_copy_element
+        if depth == 0:
+            return cached_quote
+
+        def convert_element(avro_value):
+            return cached_quote(avro_value, depth)
+        return convert_element
+    if avro_type in ("long", "double") and not null_if_convert_error:
+        # 数値はエスケープする文字を含まない
+        def convert_element(avro_value):
+            return quote + str(avro_value) + quote
+        return convert_element
+    if (type(avro_type) is dict and not null_if_convert_error
+            and (convert_composite := compile_copy_composite(avro_type, postgres_type, null_if_convert_error, depth + 1)) is not None):
+        # 入れ子の配列・レコードは、エスケープした形の要素から直接組み立てる（組み立てた文字列をエスケープし直さない）
+        def convert_element(avro_value):
+            return quote + convert_composite(avro_value) + quote
+        return convert_element
+
+    convert = compile_to_copy_value(avro_type, postgres_type, null_if_convert_error)
+
+    def convert_element(avro_value):
+        text = convert(avro_value)
+        return None if text is None else quote_copy_element_uncached(text, depth)
+    return convert_element
+
+
+def convert_boolean_to_copy_value(avro_value):
+    return "t" if avro_value else "f"
+
+
+def convert_isoformat_to_copy_value(avro_value):
+    return avro_value.isoformat()
+
+
+def convert_eventtimestamp_to_copy_value(avro_value):
+    return (DT_UTC_AWARE + datetime.timedelta(microseconds=avro_value)).isoformat()
+
+
+def compile_copy_escape(avro_type):
+    # COPYの1値をエスケープする関数（数値・真偽値・日時はエスケープする文字を含まないのでNone）
+    avro_type = strip_null_type(avro_type)
+    if avro_type == "string":
+        # 文字列は種類が少ないので、キャッシュする
+        return copy_escape
+    if avro_type in ("long", "double", "boolean"):
+        return None
+    if type(avro_type) is dict and "logicalType" in avro_type and "sqlType" not in avro_type:
+        return None
+    return copy_escape_uncached
+
+
+def compile_copy_row(schema, postgres_type_list, null_if_convert_error=False):
+    # COPY ... FROM STDIN（テキスト形式）の1行を出力する関数を返す。列順はCREATE TABLEと同じ
+    convert_list = []
+
+    for field, postgres_type in zip(schema["fields"], postgres_type_list):
+        field_name = field["name"]
+        convert = compile_to_copy_value(field["type"], postgres_type, null_if_convert_error)
+        convert_list.append((field_name, convert, compile_copy_escape(field["type"])))
+
+        if field_name == "event_timestamp":
+            convert_list.append((field_name, convert_eventtimestamp_to_copy_value, None))
+
+    def make_row(rec):
+        texts = []
+        for field_name, convert, escape_copy in convert_list:
+            text = convert(rec[field_name])
+            if text is None:
+                texts.append("\\N")
+            elif escape_copy is None:
+                texts.append(text)
+            else:
+                texts.append(escape_copy(text))
+        return "\t".join(texts) + "\n"
+    return make_row
+
+
+def make_prepared_statement(tablename, schema, postgres_type_list):
+    # format = prepared のファイルの1行目：パラメーター付きのINSERT文（改行を含まない）
+    # (3)はこれを1回だけPREPAREし、2行目以降（compile_copy_row()と同じ形の行）をパラメーターにしてEXECUTEする
+    # パラメーターの型は、CREATE TABLEと同じ型へのキャストで決める
+    insert_into = []
+    type_name_list = []
+    for field, postgres_type in zip(schema["fields"], postgres_type_list):
+        insert_into.append(field["name"])
+        type_name_list.append(postgres_type_name(postgres_type))
+        if field["name"] == "event_timestamp":
+            insert_into.append("eventtimestamp")
+            type_name_list.append("TIMESTAMP WITH TIME ZONE")
+    param_list = [f"${num}::{type_name}" for num, type_name in enumerate(type_name_list, 1)]
+    return f"INSERT INTO {tablename} ({', '.join(insert_into)}) VALUES ({', '.join(param_list)})\n"
+
+
+def make_partition_head(output_format, tablename, schema, postgres_type_list):
+    # 出力ファイルの先頭（insert: BEGIN、prepared: パラメーター付きのINSERT文）
+    if output_format == "prepared":
+        return make_prepared_statement(tablename, schema, postgres_type_list)
+    return PARTITION_HEAD[output_format]
+
+
+def make_sql_create_partition(table_name, parent_table_name="events"):
+    date_from = datetime.datetime.strptime(table_name[len(parent_table_name) + 1:], "%Y%m%d")
+    date_to = date_from + datetime.timedelta(days=1)
+    partition_stmt = f"""
+        CREATE TABLE {table_name}
+            PARTITION OF {parent_table_name}
+            FOR VALUES FROM ('{date_from.strftime("%Y%m%d")}') TO ('{date_to.strftime("%Y%m%d")}');\n
+    """
+    return textwrap.dedent(partition_stmt)[1:-1]
+
+
+def flatten_record_fields(avro_type, path, nullable):
+    # レコードの入れ子をたどり、末端の列の(パス, Avroの型)のリストを返す。nullableなレコードの下の列はnullableにする
+    column_list = []
+    for field in strip_null_type(avro_type)["fields"]:
+        field_type = copy.deepcopy(field["type"])
+        field_nullable = nullable or (type(field_type) is list and "null" in field_type)
+        inner_type = strip_null_type(field_type)
+        if type(inner_type) is dict and inner_type.get("type") == "record":
+            column_list += flatten_record_fields(inner_type, path + [field["name"]], field_nullable)
+        else:
+            if field_nullable and not (type(field_type) is list and "null" in field_type):
+                field_type = ["null", field_type]
+            column_list.append((path + [field["name"]], field_type))
+    return column_list
+
+
+def read_projection(config):
+    # [projection] 残す列と event_name（どちらも空なら全て残す）。event_dateはパーティションのキーなので必ず残す
+    # event_namesを指定した場合は、行を絞り込むのに使うevent_nameも残す
+    projection_list = []
+    for key in ("columns", "event_names"):
+        projection_list.append(tuple([name.strip() for name in config.get("projection", key, fallback="").split(",")
+                                      if name.strip() != ""]))
+    columns, event_names = projection_list
+    if 0 < len(columns) and "event_date" not in columns:
+        columns = ("event_date",) + columns
+    if 0 < len(columns) and 0 < len(event_names) and "event_name" not in columns:
+        columns = columns + ("event_name",)
+    return columns, event_names
+
+
+def projection_identity(columns, event_names):
+    # 前回の処理時と同じ列・event_nameで出力したかどうかを判定するための値（絞り込まない場合はNone）
+    if len(columns) == 0 and len(event_names) == 0:
+        return None
+    return {"columns": sorted(columns), "event_names": sorted(event_names)}
+
+
+def make_projected_schema(schema, columns):
+    # columnsの列だけを残したスキーマ（列の順番はAvroファイルのまま）
+    field_name_list = [field["name"] for field in schema["fields"]]
+    for column in columns:
+        if column not in field_name_list:
+            raise MyException(f"projection.columnsの列がありません：{column}")
+    return dict(schema, fields=[copy.deepcopy(field) for field in schema["fields"] if field["name"] in columns])
+
+
+def make_normalized_schema(schema, normalize_fields):
+    # normalize_fieldsの列（レコードの配列）をeventsから除き、子テーブルのスキーマにする
+    # eventsにはパーティション内の行番号 event_row_id を加え、子テーブルは (event_date, event_row_id, ordinal) で親の行を指す
+    # (eventsのスキーマ, [(子テーブル名, 子テーブルのスキーマ, 配列の要素から列の値を取り出すパスのリスト)]) を返す
+    field_dict = {field["name"]: field for field in schema["fields"]}
+    row_id_field = {"name": "event_row_id", "type": "long"}
+    parent_fields = []
+    for field in schema["fields"]:
+        if field["name"] in normalize_fields:
+            continue
+        parent_fields.append(copy.deepcopy(field))
+        if field["name"] == "event_date":
+            parent_fields.append(row_id_field)
+
+    child_list = []
+    for field_name in normalize_fields:
+        if field_name not in field_dict:
+            raise MyException(f"正規化する列がありません：{field_name}")
+        array_type = strip_null_type(copy.deepcopy(field_dict[field_name]["type"]))
+        if type(array_type) is not dict or array_type.get("type") != "array" \
+                or strip_null_type(array_type["items"]).get("type") != "record":
+            raise MyException(f"正規化できるのはレコードの配列の列だけです：{field_name}")
+
+        column_list = flatten_record_fields(array_type["items"], [], type(array_type["items"]) is list)
+        # 末端の列名が重なる場合だけ、パスをつないだ列名にする
+        name_list = [path[-1] for path, _ in column_list]
+        child_fields = [
+            {"name": "event_date", "type": copy.deepcopy(field_dict["event_date"]["type"])},
+            {"name": "event_row_id", "type": "long"},
+            {"name": "ordinal", "type": "long"},
+        ]
+        path_list = []
+        for path, column_type in column_list:
+            column_name = path[-1] if name_list.count(path[-1]) == 1 and path[-1] not in ("event_date", "event_row_id", "ordinal") \
+                else "_".join(path)
+            child_fields.append({"name": column_name, "type": column_type})
+            path_list.append((column_name, path))
+        child_list.append((field_name, {"type": "record", "name": field_name, "fields": child_fields}, path_list))
+    return dict(schema, fields=parent_fields), child_list
+
+
+def compile_child_rows(child_table_name, child, output_format):
+    # INSERT文の「VALUES 」まで（COPY・preparedならNone）と、eventsの1行から子テーブルの行
+    # （INSERT文の「(値, ...)」／COPYデータの1行）のリストを返す関数を返す
+    path_list = child["path_list"]
+    if output_format != "insert":
+        insert_head = None
+        make_row = compile_copy_row(child["schema"], child["postgres_type_list"], null_if_convert_error=False)
+    else:
+        insert_head, make_row = compile_sql_insert_values(
+            child_table_name, child["schema"], child["postgres_type_list"], null_if_convert_error=False)
+
+    def get_value(element, path):
+        for key in path:
+            if element is None:
+                return None
+            element = element[key]
+        return element
+
+    def make_child_rows(rec, field_name):
+        row_list = []
+        for ordinal, element in enumerate(rec[field_name] or [], 1):
+            row = {"event_date": rec["event_date"], "event_row_id": rec["event_row_id"], "ordinal": ordinal}
+            for column_name, path in path_list:
+                row[column_name] = get_value(element, path)
+            row_list.append(make_row(row))
+        return row_list
+    return insert_head, make_child_rows
+
+
+def make_sql_index(schema_plan):
+    # ロードの後で実行する索引と拡張統計。子テーブルは親の行との結合と、key・item_idでの絞り込みに使う索引を作る
+    stmt_list = ["CREATE UNIQUE INDEX IF NOT EXISTS events_event_row_id_idx ON events (event_date, event_row_id);\n"]
+    field_name_list = [field["name"] for field in schema_plan["schema"]["fields"]]
+    if "event_name" in field_name_list:
+        stmt_list.append("CREATE INDEX IF NOT EXISTS events_event_name_idx ON events (event_name, event_date);\n")
+    table_list = ["events"]
+    for child in schema_plan["child_list"]:
+        name = child["name"]
+        column_name_list = [field["name"] for field in child["schema"]["fields"]]
+        stmt_list.append(f"CREATE INDEX IF NOT EXISTS {name}_event_row_id_idx ON {name} (event_date, event_row_id);\n")
+        if "key" in column_name_list:
+            stmt_list.append(f"CREATE INDEX IF NOT EXISTS {name}_key_idx ON {name} (key, event_date);\n")
+            # 値の分布はkeyごとに大きく異なるので、keyと値の列の組み合わせの統計を取る
+            value_column_list = [column_name for column_name in ("string_value", "int_value") if column_name in column_name_list]
+            if 0 < len(value_column_list):
+                stmt_list.append(f"CREATE STATISTICS IF NOT EXISTS {name}_key_stats (ndistinct, dependencies, mcv) "
+                                 f"ON key, {', '.join(value_column_list)} FROM {name};\n")
+        if "item_id" in column_name_list:
+            stmt_list.append(f"CREATE INDEX IF NOT EXISTS {name}_item_id_idx ON {name} (item_id, event_date);\n")
+        table_list.append(name)
+    # パーティションを持つテーブルは自動ではANALYZEされない
+    stmt_list += [f"ANALYZE {name};\n" for name in table_list]
+    return "".join(stmt_list)
+
+
+def read_avro_schema(in_path_str):
+    # Avroファイルのヘッダーだけを読み、スキーマを返す
+    with open_avro_source(in_path_str) as fi:
+        return json.loads(MyReader(fi).meta["avro.schema"].decode("utf-8"))
+
+
+def avro_schema_fingerprint(schema):
+    # スキーマの指紋（キーの順序・空白によらないJSONのSHA-256）。同じ指紋のファイルはDDLも同じになる
+    schema_str = json.dumps(schema, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(schema_str.encode("utf-8")).hexdigest()
+
+
+def read_schema_cache(cache_path):
+    # Avroファイルごとの（大きさ・更新日時, スキーマの指紋）と、指紋ごとのスキーマ
+    if cache_path is None or not cache_path.exists():
+        return {"files": {}, "schemas": {}}
+    with open(cache_path, "rt", encoding="utf-8") as fi:
+        return json.load(fi)
+
+
+def make_reader_schema(schema):
+    # 古いAvroファイルを新しいスキーマで読むためのスキーマ（fastavroのスキーマ解決）
+    # 古いファイルにない列はNULLにするので、NULLを取れる列（["null", ...]）に既定値のNULLを付ける
+    def add_default(avro_type):
+        if type(avro_type) is list:
+            for union_type in avro_type:
+                add_default(union_type)
+        elif type(avro_type) is dict:
+            if avro_type.get("type") == "record":
+                for field in avro_type["fields"]:
+                    if "default" not in field and type(field["type"]) is list and field["type"][0] == "null":
+                        field["default"] = None
+                    add_default(field["type"])
+            elif avro_type.get("type") == "array":
+                add_default(avro_type["items"])
+            elif avro_type.get("type") == "map":
+                add_default(avro_type["values"])
+
+    reader_schema = copy.deepcopy(schema)
+    add_default(reader_schema)
+    return reader_schema
+
+
+def make_table_plan(schema, postgres_record_type_prefix, normalize_fields=(), columns=()):
+    # 1つのスキーマからDDLと変換に使うスキーマ／型情報を作る（パーティションによらない部分）
+    # columnsを指定すると、その列だけを残す（make_projected_schema()）
+    # normalize_fieldsを指定すると、その列を子テーブルに分ける（make_normalized_schema()）
+    # DDLを作るときにスキーマを書き換えるので、キャッシュしたスキーマはコピーして使う
+    schema = copy.deepcopy(schema)
+    if 0 < len(columns):
+        schema = make_projected_schema(schema, columns)
+    child_list = []
+    if 0 < len(normalize_fields):
+        schema, normalized_child_list = make_normalized_schema(schema, normalize_fields)
+        for child_name, child_schema, path_list in normalized_child_list:
+            # 子テーブルの型名は子テーブル名で始める（eventsの型と重ならないように）
+            child_ddl_queue = deque()
+            child_postgres_type_list = make_sql_create_table(child_name, child_schema["fields"], child_ddl_queue, child_name)
+            child_list.append({
+                "name": child_name,
+                "schema": child_schema,
+                "postgres_type_list": child_postgres_type_list,
+                "path_list": path_list,
+                "create_table_stmt": child_ddl_queue.pop(),
+                "create_type_stmt": "".join(child_ddl_queue),
+            })
+
+    ddl_queue = deque()
+    postgres_type_list = make_sql_create_table("events", schema["fields"], ddl_queue, postgres_record_type_prefix)
+    create_table_stmt = ddl_queue.pop()
+    return {
+        "schema": schema,
+        "postgres_type_list": postgres_type_list,
+        "create_table_stmt": create_table_stmt,
+        "create_type_stmt": "".join(ddl_queue),
+        "child_list": child_list,
+    }
+
+
+def parse_create_type_stmts(create_type_stmt):
+    # 「CREATE TYPE 型名 AS (...);」の並びを {型名: [属性, ...]} にする（DDLの順）
+    return {type_name: attributes.split("\n  , ") for type_name, attributes
+            in re.findall(r"CREATE TYPE (\w+) AS \(\n    (.*?)\n\);\n", create_type_stmt, re.S)}
+
+
+def make_sql_alter_table(table_name, old_create_table_stmt, old_create_type_stmt, create_table_stmt, create_type_stmt):
+    # 古いDDLのテーブル・型を新しいDDLにするALTER文のリスト（作れなければNone）
+    # 列・属性は末尾に追加されたものだけを扱う（COPYデータ・複合型の値は列・属性の順番で対応するため）
+    # (3)が何度実行してもよいように、既にあれば何もしない
+    old_type_dict = parse_create_type_stmts(old_create_type_stmt)
+    type_dict = parse_create_type_stmts(create_type_stmt)
+    if any([type_name not in type_dict for type_name in old_type_dict]):
+        return None
+    stmt_list = []
+    for type_name, attribute_list in type_dict.items():
+        if type_name not in old_type_dict:
+            attributes = "\n  , ".join(attribute_list)
+            stmt_list.append(f"DO $$ BEGIN IF to_regtype('{type_name}') IS NULL THEN CREATE TYPE {type_name} AS (\n"
+                             f"    {attributes}\n); END IF; END $$;\n")
+            continue
+        old_attribute_list = old_type_dict[type_name]
+        if attribute_list[:len(old_attribute_list)] != old_attribute_list:
+            return None
+        for attribute in attribute_list[len(old_attribute_list):]:
+            attribute_name = attribute.split(" ", 1)[0]
+            stmt_list.append(f"DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass('{type_name}') "
+                             f"AND attname = '{attribute_name}' AND NOT attisdropped) THEN "
+                             f"ALTER TYPE {type_name} ADD ATTRIBUTE {attribute} CASCADE; END IF; END $$;\n")
+
+    old_column_list = old_create_table_stmt.strip().rstrip(")").strip().split("\n  , ")
+    column_list = create_table_stmt.strip().rstrip(")").strip().split("\n  , ")
+    if column_list[:len(old_column_list)] != old_column_list:
+        return None
+    for column in column_list[len(old_column_list):]:
+        # 既存の行があるので、NOT NULLの列は追加できない
+        if " NOT NULL" in column:
+            return None
+        stmt_list.append(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column};\n")
+    return stmt_list
+
+
+def make_sql_alter(old_table_plan, table_plan):
+    # old_table_planのDDLで作ったテーブルを、table_planのDDLに合わせるALTER文のリスト（作れなければNone）
+    if [child["name"] for child in old_table_plan["child_list"]] != [child["name"] for child in table_plan["child_list"]]:
+        return None
+    stmt_list = []
+    for name, old_plan, plan in [("events", old_table_plan, table_plan)] \
+            + [(child["name"], old_child, child) for old_child, child in zip(old_table_plan["child_list"], table_plan["child_list"])]:
+        alter_stmt_list = make_sql_alter_table(name, old_plan["create_table_stmt"], old_plan["create_type_stmt"],
+                                               plan["create_table_stmt"], plan["create_type_stmt"])
+        if alter_stmt_list is None:
+            return None
+        stmt_list += alter_stmt_list
+    return stmt_list
+
+
+def make_schema_plan(avro_list, postgres_record_type_prefix, normalize_fields=(), columns=(), cache_path=None,
+                     source_identity_dict=None):
+    # 全Avroファイルのスキーマが同じ（または新しいスキーマで読める）ことを確認し、DDLと変換に使うスキーマ／型情報を返す
+    # DDLは最も新しいAvroファイル（avro_listの先頭）のスキーマで作り、スキーマの指紋ごとに1回だけ作る
+    # cache_pathを指定すると、ファイルの指紋とスキーマをキャッシュし、前回から変わっていないファイルはヘッダーを読まない
+    # source_identity_dictを指定すると、求めたファイルの大きさ・更新日時を入れる（マニフェストの確認で使い回す）
+    cache = read_schema_cache(cache_path)
+    file_dict = {}
+    fingerprint_list = []
+    for in_path_str in avro_list:
+        entry = None
+        if cache_path is not None:
+            source_identity = avro_source_identity(in_path_str)
+            if source_identity_dict is not None:
+                source_identity_dict[in_path_str] = source_identity
+            entry = cache["files"].get(in_path_str)
+            if entry is not None and (entry.get("source") != source_identity or entry.get("fingerprint") not in cache["schemas"]):
+                entry = None
+        if entry is None:
+            schema = read_avro_schema(in_path_str)
+            fingerprint = avro_schema_fingerprint(schema)
+            cache["schemas"][fingerprint] = schema
+            entry = {"source": source_identity if cache_path is not None else None, "fingerprint": fingerprint}
+        file_dict[in_path_str] = entry
+        fingerprint_list.append(entry["fingerprint"])
+
+    # 指紋ごとにDDLを作り、最も新しいスキーマのDDLと比べる
+    fingerprint0 = fingerprint_list[0]
+    table_plan_dict = {fingerprint0: make_table_plan(cache["schemas"][fingerprint0], postgres_record_type_prefix,
+                                                     normalize_fields, columns)}
+    schema_plan = table_plan_dict[fingerprint0]
+    reader_schema_dict = {}
+    added_dict = {fingerprint0: False}
+    for in_path_str, fingerprint in zip(avro_list, fingerprint_list):
+        if fingerprint not in table_plan_dict:
+            table_plan_dict[fingerprint] = make_table_plan(cache["schemas"][fingerprint], postgres_record_type_prefix,
+                                                           normalize_fields, columns)
+            alter_stmt_list = make_sql_alter(table_plan_dict[fingerprint], schema_plan)
+            if alter_stmt_list is None:
+                raise MyException(f"Avroファイル間にスキーマの差異が検出されました。処理を中断します。{in_path_str}")
+            # DDLが同じ（説明・レコード名等だけが違う）なら、ファイル自身のスキーマで読む
+            added_dict[fingerprint] = 0 < len(alter_stmt_list)
+        if added_dict[fingerprint]:
+            # 列が追加される前の古いファイルは、新しいスキーマで読む
+            if "reader_schema" not in schema_plan:
+                schema_plan["reader_schema"] = make_reader_schema(cache["schemas"][fingerprint0])
+            reader_schema_dict[in_path_str] = schema_plan["reader_schema"]
+    schema_plan.pop("reader_schema", None)
+    schema_plan["reader_schema_dict"] = reader_schema_dict
+    schema_plan["fingerprint"] = fingerprint0
+
+    partition_stmt_list = []
+    for in_path_str in avro_list:
+        table_name = Path(in_path_str).stem.lower()
+        for child in schema_plan["child_list"]:
+            partition_stmt_list.append(make_sql_create_partition(make_child_table_name(child["name"], table_name), child["name"]))
+        partition_stmt_list.append(make_sql_create_partition(table_name))
+    schema_plan["partition_stmt_list"] = partition_stmt_list
+
+    # 最初にDDLを作ったとき（base）からスキーマが変わっていれば、既存のテーブルに対するALTER文を作る
+    schema_plan["alter_stmt_list"] = []
+    if cache_path is not None:
+        base = {"fingerprint": fingerprint0, "normalize_fields": list(normalize_fields), "columns": sorted(columns)}
+        old_base = cache.get("base")
+        if old_base is not None and old_base["fingerprint"] != fingerprint0 and old_base["fingerprint"] in cache["schemas"] \
+                and old_base["normalize_fields"] == base["normalize_fields"] and old_base["columns"] == base["columns"]:
+            alter_stmt_list = make_sql_alter(make_table_plan(cache["schemas"][old_base["fingerprint"]], postgres_record_type_prefix,
+                                                             normalize_fields, columns), schema_plan)
+            if alter_stmt_list is None:
+                raise MyException(f"前回からスキーマが変わり、既存のテーブルに対するALTER文を作れません。処理を中断します。"
+                                  f"テーブルを作り直す場合は {cache_path} を削除してください。")
+            schema_plan["alter_stmt_list"] = alter_stmt_list
+            base = old_base
+        cache = {
+            "base": base,
+            "files": file_dict,
+            "schemas": {fingerprint: cache["schemas"][fingerprint]
+                        for fingerprint in set(fingerprint_list) | {base["fingerprint"]}},
+        }
+        # 書き方はマニフェストと同じ（書きかけのファイルを残さない）
+        write_manifest(cache_path, cache)
+    return schema_plan
+
+
+def make_sql_alter_ddl(schema_plan):
+    # 既存のテーブルに、前回から追加された列・属性を加える（(3)はeventsテーブルが既にあるときに実行する）
+    return "BEGIN;\n" + "".join(schema_plan["alter_stmt_list"]) + "COMMIT;\n"
+
+
+def make_sql_ddl(schema_plan):
+    # トランザクション開始
+    ddl = "BEGIN;\n"
+
+    # DDL
+    ddl += schema_plan["create_type_stmt"]
+    ddl += f"CREATE TABLE events (\n{schema_plan['create_table_stmt']} PARTITION BY RANGE (event_date);\n"
+    for child in schema_plan["child_list"]:
+        ddl += child["create_type_stmt"]
+        ddl += f"CREATE TABLE {child['name']} (\n{child['create_table_stmt']} PARTITION BY RANGE (event_date);\n"
+    for partition_stmt in reversed(schema_plan["partition_stmt_list"]):
+        ddl += partition_stmt
+
+    # トランザクション終了
+    ddl += "COMMIT;\n"
+    return ddl
+
+
+def read_avro_long(fi):
+    # Avroのlong（zigzag可変長整数）を読む。ファイル末尾ならNoneを返す
+    b = fi.read(1)
+    if len(b) == 0:
+        return None
+    n = b[0]
+    value = n & 0x7F
+    shift = 7
+    while n & 0x80:
+        n = fi.read(1)[0]
+        value |= (n & 0x7F) << shift
+        shift += 7
+    return (value >> 1) ^ -(value & 1)
+
+
+def scan_avro_blocks(fi):
+    # Avroファイルのヘッダーサイズと、各ブロックの(開始位置, 終了位置, 行数)を返す（展開はしない）
+    if fi.read(4) != b"Obj\x01":
+        raise MyException(f"Avroファイルではありません：{fi.name}")
+    while True:
+        count = read_avro_long(fi)
+        if count == 0:
+            break
+        if count < 0:
+            count = -count
+            read_avro_long(fi)
+        for _ in range(count * 2):
+            fi.seek(read_avro_long(fi), 1)
+    fi.seek(SYNC_SIZE, 1)
+    header_size = fi.tell()
+
+    block_list = []
+    while True:
+        block_start = fi.tell()
+        count = read_avro_long(fi)
+        if count is None:
+            break
+        fi.seek(read_avro_long(fi) + SYNC_SIZE, 1)
+        block_list.append((block_start, fi.tell(), count))
+    return header_size, block_list
+
+
+def split_avro_blocks(in_path_str, split_size):
+    # ブロック境界でsplit_sizeバイト程度ずつに分割し、(ヘッダーサイズ, 開始位置, 終了位置, 先行する行数)のリストを返す
+    with open(in_path_str, "rb") as fi:
+        header_size, block_list = scan_avro_blocks(fi)
+
+    chunk_list = []
+    chunk_start = header_size
+    num_start = 0
+    num = 0
+    for _, block_end, count in block_list:
+        num += count
+        if split_size <= block_end - chunk_start:
+            chunk_list.append((header_size, chunk_start, block_end, num_start))
+            chunk_start = block_end
+            num_start = num
+    file_end = block_list[-1][1] if 0 < len(block_list) else header_size
+    if chunk_start < file_end or len(chunk_list) == 0:
+        chunk_list.append((header_size, chunk_start, file_end, num_start))
+    return chunk_list
+
+
+def read_avro_chunk(fi, header_size, chunk_start, chunk_end):
+    # ヘッダーと指定範囲のブロックだけを持つAvroファイルをメモリ上に作る
+    header = fi.read(header_size)
+    fi.seek(chunk_start)
+    return io.BytesIO(header + fi.read(chunk_end - chunk_start))
+
+
+def child_out_path(out_path_str, table_name, child_name):
+    # 子テーブルの出力ファイル（events_YYYYMMDD.sql -> event_params_YYYYMMDD.sql、分割した場合の .partN も同様）
+    out_path = Path(out_path_str)
+    return str(out_path.with_name(out_path.name.replace(table_name, make_child_table_name(child_name, table_name), 1)))
+
+
+def make_child_table_name(child_name, table_name):
+    # 子テーブルのパーティション名（events_YYYYMMDD -> event_params_YYYYMMDD）
+    return f"{child_name}_{table_name.rsplit('_', 1)[1]}"
+
+
+def output_partition_name(out_path_str):
+    # 出力ファイルのパーティション名（events_YYYYMMDD.sql.gz -> events_YYYYMMDD）
+    name = Path(out_path_str).name
+    for suffix in COMPRESSION_SUFFIX.values():
+        if suffix != "" and name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return Path(name).stem
+
+
+def open_output(out_path_str, compression="none", compression_level=None):
+    # 出力ファイルをテキストモードで開く。gzip / zstd なら書きながら圧縮する
+    if compression == "none":
+        return open(out_path_str, "wt", encoding="utf-8")
+    elif compression == "gzip":
+        return gzip.open(out_path_str, "wt", compresslevel=compression_level, encoding="utf-8")
+    else:
+        # zstdを使うときだけzstandardを読み込む
+        import zstandard
+        return zstandard.open(out_path_str, "wt", cctx=zstandard.ZstdCompressor(level=compression_level), encoding="utf-8")
+
+
+def compress_bytes(data, compression="none", compression_level=None):
+    # join_partition_chunks()で連結するBEGIN/COMMITの外枠（gzipのメンバー／zstdのフレームは連結しても1つのファイルとして読める）
+    if compression == "none":
+        return data
+    elif compression == "gzip":
+        return gzip.compress(data, compresslevel=compression_level)
+    else:
+        import zstandard
+        return zstandard.ZstdCompressor(level=compression_level).compress(data)
+
+
+def convert_partition(in_path_str, out_path_str, table_name, schema, postgres_type_list, converter, output_format,
+                      chunk=None, read_ahead=None, insert_rows=1, commit="rows", commit_rows=COMMIT_NUM, child_list=(),
+                      event_names=(), compression="none", compression_level=None, reader_schema=None):
+    # 1パーティション分のAvroファイルをINSERT文／COPYデータ／パラメーター付きのINSERT文とその行に変換し、行数とescape()のキャッシュのヒット数・ミス数を返す
+    # 秒数は全体と、Avroのデコード（読み込みを含む）・変換（書き込みを含む）の内訳を返す
+    # chunkを指定した場合はその範囲のブロックだけを変換し、BEGIN/COMMITの外枠は書かない（join_partition_chunks()で付ける）
+    # INSERT文はinsert_rows行ずつ1文にまとめ、commitに従ってCOMMITする
+    # （rows: commit_rows行ごと、batch: INSERT文ごと、partition: パーティションの最後だけ）
+    # child_listを指定すると、子テーブルの行を child_out_path() のファイルに書く（INSERT文の区切りとCOMMITの位置はeventsと同じ）
+    # event_namesを指定すると、それ以外のevent_nameの行を除く（行番号は除いた行も数えるので、分割しても結果は同じ）
+    # compressionを指定すると、出力ファイルを書きながら圧縮する（open_output()）
+    # reader_schemaを指定すると、そのスキーマで読む（列が追加される前の古いファイル。make_schema_plan()）
+    start = time.perf_counter()
+    escape_hits_start, escape_misses_start = escape_cache_counts()
+    with open_avro_source(in_path_str, read_ahead) as fi, contextlib.ExitStack() as stack:
+        if chunk is None:
+            reader = MyReader(fi, reader_schema)
+            num_start = 0
+        else:
+            header_size, chunk_start, chunk_end, num_start = chunk
+            reader = MyReader(read_avro_chunk(fi, header_size, chunk_start, chunk_end), reader_schema)
+
+        if output_format != "insert":
+            # preparedの行はCOPYデータと同じ形
+            insert_head = None
+            make_row = compile_copy_row(schema, postgres_type_list, null_if_convert_error=False)
+        elif converter == "compiled":
+            insert_head, make_row = compile_sql_insert_values(table_name, schema, postgres_type_list, null_if_convert_error=False)
+        else:
+            # 1行ずつのINSERT文から、末尾の「;\n」を除いたもの
+            insert_head = ""
+
+            def make_row(rec):
+                return make_sql_insert(table_name, schema, postgres_type_list, rec, null_if_convert_error=False)[:-2]
+
+        # 出力ファイルごとの [ファイル, INSERT文の「VALUES 」まで, 書いていない行] と、子テーブルの [列名, 行を作る関数, 出力]
+        fo = stack.enter_context(open_output(out_path_str, compression, compression_level))
+        values_list = []
+        output_list = [(fo, insert_head, values_list)]
+        partition_head_list = [make_partition_head(output_format, table_name, schema, postgres_type_list)]
+        child_row_list = []
+        for child in child_list:
+            child_table_name = make_child_table_name(child["name"], table_name)
+            child_insert_head, make_child_rows = compile_child_rows(child_table_name, child, output_format)
+            child_fo = stack.enter_context(open_output(child_out_path(out_path_str, table_name, child["name"]),
+                                                       compression, compression_level))
+            output_list.append((child_fo, child_insert_head, []))
+            partition_head_list.append(make_partition_head(output_format, child_table_name, child["schema"],
+                                                           child["postgres_type_list"]))
+            child_row_list.append((child["name"], make_child_rows, output_list[-1]))
+
+        # トランザクション開始
+        if chunk is None:
+            for (output_fo, _, _), partition_head in zip(output_list, partition_head_list):
+                output_fo.write(partition_head)
+
+        # INSERT文／COPYデータ（INSERT文の区切りとCOMMITの位置はパーティション先頭からの行番号で決める）
+        num = num_start
+        num_flushed = num_start
+        rows = 0
+        child_rows = 0
+        event_name_set = frozenset(event_names)
+        decode_seconds = 0.0
+        convert_seconds = 0.0
+        perf_counter = time.perf_counter
+
+        def write_insert(num_flushed):
+            # 前回書いた行番号 num_flushed の次から num までの行を書く
+            commit_after = commit == "batch" or (commit == "rows" and num_flushed // commit_rows != num // commit_rows)
+            for output_fo, output_insert_head, output_values_list in output_list:
+                if 0 < len(output_values_list):
+                    output_fo.write(f"{output_insert_head}{', '.join(output_values_list)};\n")
+                    output_values_list.clear()
+                if commit_after:
+                    output_fo.write("COMMIT;\nBEGIN;\n")
+
+        t0 = perf_counter()
+        for rec in reader:
+            t1 = perf_counter()
+            decode_seconds += t1 - t0
+            num += 1
+            if 0 < len(event_name_set) and rec["event_name"] not in event_name_set:
+                if output_format == "insert" and num % insert_rows == 0 and 0 < len(values_list):
+                    write_insert(num_flushed)
+                    num_flushed = num
+                t0 = perf_counter()
+                convert_seconds += t0 - t1
+                continue
+            rows += 1
+            if 0 < len(child_row_list):
+                rec["event_row_id"] = num
+            if output_format != "insert":
+                fo.write(make_row(rec))
+            else:
+                values_list.append(make_row(rec))
+            if 0 < len(child_row_list):
+                for field_name, make_child_rows, (child_fo, _, child_values_list) in child_row_list:
+                    row_list = make_child_rows(rec, field_name)
+                    child_rows += len(row_list)
+                    if output_format != "insert":
+                        child_fo.write("".join(row_list))
+                    else:
+                        child_values_list.extend(row_list)
+            if output_format == "insert" and num % insert_rows == 0:
+                write_insert(num_flushed)
+                num_flushed = num
+            t0 = perf_counter()
+            convert_seconds += t0 - t1
+        decode_seconds += perf_counter() - t0
+
+        # 分割した場合は、その範囲の最後でもINSERT文を区切る
+        if 0 < len(values_list):
+            write_insert(num_flushed)
+
+        # トランザクション終了
+        if chunk is None:
+            for output_fo, _, _ in output_list:
+                output_fo.write(PARTITION_TAIL[output_format])
+
+    escape_hits, escape_misses = escape_cache_counts()
+    return {
+        "rows": rows,
+        "filtered_rows": num - num_start - rows,
+        "child_rows": child_rows,
+        "escape_hits": escape_hits - escape_hits_start,
+        "escape_misses": escape_misses - escape_misses_start,
+        "seconds": time.perf_counter() - start,
+        "decode_seconds": decode_seconds,
+        "convert_seconds": convert_seconds,
+    }
+
+
+class SamplingProfiler:
+    # CPU時間で一定間隔ごとに（SIGPROF）、実行中のスタックを採取する。メインスレッドでのみ使える
+    # collapsed形式（1行に「関数;関数;... 回数」）で書き出し、flamegraph.pl や speedscope で見る
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stack_counts = {}
+        self.previous_handler = None
+
+    def __enter__(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.stack_counts[key] = self.stack_counts.get(key, 0) + 1
+
+    def write(self, path):
+        with open(path, "wt", encoding="utf-8") as fo:
+            for stack, count in sorted(self.stack_counts.items()):
+                fo.write(f"{stack} {count}\n")
+
+
+def convert_partition_profiled(profile, profile_home, in_path_str, out_path_str, *args, **kwargs):
+    # convert_partition()をプロファイラー付きで実行し、profile_home/出力ファイル名.prof（cprofile）／.folded（sample）に書き出す
+    # （プロセスプールに渡せるように、モジュールの関数にしておく）
+    profile_path = Path(profile_home) / Path(out_path_str).name
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+        result = profiler.runcall(convert_partition, in_path_str, out_path_str, *args, **kwargs)
+        profiler.dump_stats(f"{profile_path}.prof")
+    else:
+        with SamplingProfiler() as profiler:
+            result = convert_partition(in_path_str, out_path_str, *args, **kwargs)
+        profiler.write(f"{profile_path}.folded")
+    return result
+
+
+def join_partition_chunks(out_path_str, part_path_list, output_format, compression="none", compression_level=None,
+                          partition_head=None):
+    # 分割して変換した結果を元の行順に連結する（圧縮した場合も展開せずに連結する）
+    # partition_headはファイルの先頭（make_partition_head()、省略するとPARTITION_HEAD）
+    if partition_head is None:
+        partition_head = PARTITION_HEAD[output_format]
+    with open(out_path_str, "wb") as fo:
+        if partition_head != "":
+            fo.write(compress_bytes(partition_head.encode("utf-8"), compression, compression_level))
+        for part_path_str in part_path_list:
+            with open(part_path_str, "rb") as fi:
+                shutil.copyfileobj(fi, fo)
+            os.remove(part_path_str)
+        if PARTITION_TAIL[output_format] != "":
+            fo.write(compress_bytes(PARTITION_TAIL[output_format].encode("utf-8"), compression, compression_level))
+
+
+def output_unchanged(manifest, out_path_str):
+    # 出力ファイルが前回の変換時のまま残っているか
+    entry = manifest["partitions"].get(output_partition_name(out_path_str), {}).get("avro_to_sql")
+    return entry is not None and Path(out_path_str).exists() and Path(out_path_str).stat().st_size == entry.get("size")
+
+
+def stale_output_paths(out_path_str):
+    # 同じパーティションの、形式・圧縮が違う前回の出力ファイル（(3)は同じパーティションのファイルが混在すると中断する）
+    out_path = Path(out_path_str)
+    name = output_partition_name(out_path_str)
+    path_list = []
+    for output_suffix in OUTPUT_SUFFIX.values():
+        for compression_suffix in COMPRESSION_SUFFIX.values():
+            path = out_path.with_name(f"{name}{output_suffix}{compression_suffix}")
+            if path != out_path and path.exists():
+                path_list.append(path)
+    return path_list
+
+
 def main():
     config_path = Path.cwd() / "ga4_from_avro_to_sql.ini"
     config = read_config(config_path)
-    local_in_home = Path.cwd() / config["local"]["avro_home"]
     local_out_home = Path.cwd() / config["local"]["sql_home"]
 
-    avro_list = glob.glob(str(local_in_home) + "/*/events_*.avro")
+    avro_list = list_avro_sources(config)
     print(f"Avroファイル数：{len(avro_list)}")
     if len(avro_list) == 0:
         return
@@ -299,89 +1606,280 @@ def main():
     avro_list.sort(reverse=True)
     postgres_record_type_prefix = "events"
 
-    # DDL
-    partition_stmt_list = []
+    # 値の変換方式（compiled: スキーマから変換関数を組み立てる、legacy: 値ごとに型を判定する）
+    converter = config.get("convert", "converter", fallback="compiled")
+    if converter not in ("compiled", "legacy"):
+        raise MyException(f"convert.converterの値が不正です：{converter}")
+
+    # 出力形式（insert: INSERT文、copy: COPY ... FROM STDIN のテキスト形式、
+    # prepared: 1行目がパラメーター付きのINSERT文、2行目以降がCOPYと同じ形のパラメーターの行。(3)がPREPARE・EXECUTEする）
+    output_format = config.get("convert", "format", fallback="insert")
+    if output_format not in OUTPUT_SUFFIX:
+        raise MyException(f"convert.formatの値が不正です：{output_format}")
+    if output_format != "insert" and converter == "legacy":
+        raise MyException(f"convert.format = {output_format} は convert.converter = compiled でのみ使用できます。")
+
+    # テーブルの形（nested: 配列の列を複合型の配列にする、normalized: normalize_fieldsの列を子テーブルに分ける）
+    schema_mode = config.get("convert", "schema", fallback="nested")
+    if schema_mode not in ("nested", "normalized"):
+        raise MyException(f"convert.schemaの値が不正です：{schema_mode}")
+    if schema_mode == "normalized" and converter == "legacy":
+        raise MyException(f"convert.schema = normalized は convert.converter = compiled でのみ使用できます。")
+    normalize_fields = ()
+    if schema_mode == "normalized":
+        normalize_fields = tuple([field_name.strip() for field_name in
+                                  config.get("convert", "normalize_fields", fallback=",".join(NORMALIZE_FIELDS)).split(",")
+                                  if field_name.strip() != ""])
+
+    # 残す列とevent_name（[projection]、(1)で絞り込んでいない場合もここで絞り込む）
+    columns, event_names = read_projection(config)
+    projection = projection_identity(columns, event_names)
+    if 0 < len(columns):
+        normalize_fields = tuple([field_name for field_name in normalize_fields if field_name in columns])
+
+    # 1つのINSERT文にまとめる行数と、COMMITの単位（rows: commit_rows行ごと、batch: INSERT文ごと、partition: パーティションごと）
+    insert_rows = config.getint("convert", "insert_rows", fallback=1)
+    if insert_rows < 1:
+        raise MyException(f"convert.insert_rowsの値が不正です：{insert_rows}")
+    if 1 < insert_rows and converter == "legacy":
+        raise MyException(f"convert.insert_rows = {insert_rows} は convert.converter = compiled でのみ使用できます。")
+    commit = config.get("convert", "commit", fallback="rows")
+    if commit not in ("rows", "batch", "partition"):
+        raise MyException(f"convert.commitの値が不正です：{commit}")
+    commit_rows = config.getint("convert", "commit_rows", fallback=COMMIT_NUM)
+    if commit_rows < 1:
+        raise MyException(f"convert.commit_rowsの値が不正です：{commit_rows}")
+
+    # 出力ファイルの圧縮（none / gzip / zstd）と圧縮レベル
+    compression = config.get("convert", "compression", fallback="none")
+    if compression not in COMPRESSION_SUFFIX:
+        raise MyException(f"convert.compressionの値が不正です：{compression}")
+    compression_level = None
+    if compression != "none":
+        level_min, level_max, level_default = COMPRESSION_LEVEL[compression]
+        compression_level = config.get("convert", "compression_level", fallback="").strip()
+        compression_level = int(compression_level) if compression_level != "" else level_default
+        if not level_min <= compression_level <= level_max:
+            raise MyException(f"convert.compression_levelの値が不正です：{compression_level}（{compression}: {level_min}～{level_max}）")
+
+    # 出力ファイルの中身を決める設定（前回と違えば、Avroファイルが変わっていなくても出力し直す）
+    output_options = {"converter": converter, "format": output_format, "insert_rows": insert_rows, "commit": commit,
+                      "commit_rows": commit_rows, "compression": compression, "compression_level": compression_level}
+
+    # 並列に変換するプロセス数（0: CPUコア数）
+    workers = config.getint("convert", "workers", fallback=1)
+    if workers < 0:
+        raise MyException(f"convert.workersの値が不正です：{workers}")
+    if workers == 0:
+        workers = os.cpu_count()
+
+    # この大きさ(MB)を超えるAvroファイルはブロック単位で分割して並列に変換する（0: 分割しない）
+    split_size = config.getint("convert", "split_mb", fallback=0) * 1024 * 1024
+
+    # GCSから直接読む場合の先読みの単位(MB)と個数
+    read_ahead = (config.getint("GCS", "read_ahead_mb", fallback=8) * 1024 * 1024,
+                  config.getint("GCS", "read_ahead_chunks", fallback=4))
+
+    # escape()のキャッシュに保持する文字列の数（0: キャッシュしない）
+    set_escape_cache_size(config.getint("convert", "escape_cache_size", fallback=ESCAPE_CACHE_SIZE))
+
+    # 処理状況を記録するファイル（指定がなければ記録しない）
+    manifest_path = None
+    if config.has_option("manifest", "path"):
+        manifest_path = Path.cwd() / config["manifest"]["path"]
+
+    # パーティションごとの処理時間・行数・バイト数
+    metrics = open_stage_metrics(config, "avro_to_sql")
+
+    # 変換をプロファイラー付きで実行する（cprofile: cProfile、sample: スタックの採取、空: 実行しない）
+    profile = config.get("metrics", "profile", fallback="")
+    if profile not in ("", "cprofile", "sample"):
+        raise MyException(f"metrics.profileの値が不正です：{profile}")
+    if profile == "":
+        convert_func = convert_partition
+    else:
+        profile_home = Path.cwd() / config.get("metrics", "profile_home", fallback="profile")
+        profile_home.mkdir(parents=True, exist_ok=True)  # ディレクトリがなければ作成
+        convert_func = functools.partial(convert_partition_profiled, profile, str(profile_home))
+    convert_func = functools.partial(convert_func, insert_rows=insert_rows, commit=commit, commit_rows=commit_rows,
+                                     event_names=event_names, compression=compression,
+                                     compression_level=compression_level)
+
+    # DDL（スキーマの指紋を出力ディレクトリにキャッシュし、前回から変わっていないAvroファイルはヘッダーを読まない）
     local_out_home.mkdir(parents=True, exist_ok=True)  # ディレクトリがなければ作成
+    source_identity_dict = {}
+    schema_plan = make_schema_plan(avro_list, postgres_record_type_prefix, normalize_fields, columns,
+                                   local_out_home / SCHEMA_CACHE_NAME, source_identity_dict)
+    schema0 = schema_plan["schema"]
+    postgres_type_list0 = schema_plan["postgres_type_list"]
+    reader_schema_dict = schema_plan["reader_schema_dict"]
+    if 0 < len(reader_schema_dict):
+        print(f"列が追加される前のAvroファイル数：{len(reader_schema_dict)}（最も新しいスキーマで読みます）")
     out_ddl_path = local_out_home / f"{Path(avro_list[0]).stem.lower()}_ddl.sql"
     with open(out_ddl_path, "wt", encoding="utf-8") as fo_ddl:
-        try:
-            for index, in_path_str in enumerate(avro_list, 1):
-                in_path = Path(in_path_str)
-                table_name = in_path.stem.lower()
-
-                with open(in_path, "rb") as fi:
-                    reader = MyReader(fi)
-                    schema = json.loads(reader.meta["avro.schema"].decode("utf-8"))
-
-                    ddl_queue = deque()
-                    make_sql_create_table(table_name, schema["fields"], ddl_queue, postgres_record_type_prefix)
-                    create_table_stmt = ddl_queue.pop()
-                    create_type_stmt = "".join(ddl_queue)
-
-                    date_from = datetime.datetime.strptime(table_name[7:], "%Y%m%d")
-                    date_to = date_from + datetime.timedelta(days=1)
-                    partition_stmt = f"""
-                        CREATE TABLE {table_name}
-                            PARTITION OF events
-                            FOR VALUES FROM ('{date_from.strftime("%Y%m%d")}') TO ('{date_to.strftime("%Y%m%d")}');\n
-                    """
-                    partition_stmt_list.append(textwrap.dedent(partition_stmt)[1:-1])
-                    if index == 1:
-                        create_table_stmt0 = create_table_stmt
-                        create_type_stmt0 = create_type_stmt
-                    elif create_table_stmt == create_table_stmt0 and create_type_stmt == create_type_stmt0:
-                        pass
-                    else:
-                        raise MyException(f"Avroファイル間にスキーマの差異が検出されました。処理を中断します。{in_path_str}")
-        finally:
-            # トランザクション開始
-            fo_ddl.write("BEGIN;\n")
+        fo_ddl.write(make_sql_ddl(schema_plan))
 
-            # DDL
-            fo_ddl.write(create_type_stmt)
-            fo_ddl.write(f"CREATE TABLE events (\n{create_table_stmt} PARTITION BY RANGE (event_date);\n")
-            for partition_stmt in reversed(partition_stmt_list):
-                fo_ddl.write(partition_stmt)
+    # 前回のDDLから列・属性が追加されていれば、既存のテーブルに対するALTER文（(3)が実行する）
+    out_alter_path = local_out_home / f"{Path(avro_list[0]).stem.lower()}_alter.sql"
+    if 0 < len(schema_plan["alter_stmt_list"]):
+        print(f"前回のDDLから追加された列・属性：{len(schema_plan['alter_stmt_list'])}件")
+        with open(out_alter_path, "wt", encoding="utf-8") as fo_alter:
+            fo_alter.write(make_sql_alter_ddl(schema_plan))
+    for alter_path_str in glob.glob(str(local_out_home) + "/events_*_alter.sql"):
+        if Path(alter_path_str) != out_alter_path or len(schema_plan["alter_stmt_list"]) == 0:
+            os.remove(alter_path_str)
 
-            # トランザクション終了
-            fo_ddl.write("COMMIT;\n")
+    # 新しい日付のAvroファイルが増えるとDDLファイル名が変わるので、古いDDLファイルを消す（(3)はDDLファイルが1つであることを前提とする）
+    for ddl_path_str in glob.glob(str(local_out_home) + "/events_*_ddl.sql"):
+        if Path(ddl_path_str) != out_ddl_path:
+            os.remove(ddl_path_str)
 
-    local_in_home_str = str(local_in_home.absolute())
-    local_out_home_str = str(local_out_home.absolute())
+    # ロードの後で実行する索引と拡張統計（normalizedのみ）
+    out_index_path = local_out_home / f"{Path(avro_list[0]).stem.lower()}_index.sql"
+    if schema_mode == "normalized":
+        with open(out_index_path, "wt", encoding="utf-8") as fo_index:
+            fo_index.write(make_sql_index(schema_plan))
+    for index_path_str in glob.glob(str(local_out_home) + "/events_*_index.sql"):
+        if Path(index_path_str) != out_index_path or schema_mode != "normalized":
+            os.remove(index_path_str)
+    child_name_list = [child["name"] for child in schema_plan["child_list"]]
+    convert_func = functools.partial(convert_func, child_list=schema_plan["child_list"])
 
-    # INSERT文
-    for index, in_path_str in enumerate(avro_list, 1):
+    # INSERT文／COPYデータ
+    task_list = []
+    for in_path_str in avro_list:
         in_path = Path(in_path_str)
         table_name = in_path.stem.lower()
 
-        in_path_parent_str = str(in_path.parent.absolute())
-        out_dir = Path(in_path_parent_str.replace(local_in_home_str, local_out_home_str))
-
+        out_dir = local_out_home / in_path.parent.name
         out_dir.mkdir(parents=True, exist_ok=True)  # ディレクトリがなければ作成
-        out_path = out_dir / f"{table_name}.sql"
-        with open(in_path, "rb") as fi, open(out_path, "wt", encoding="utf-8") as fo:
-            reader = MyReader(fi)
-            schema = json.loads(reader.meta["avro.schema"].decode("utf-8"))
+        out_path = out_dir / f"{table_name}{OUTPUT_SUFFIX[output_format]}{COMPRESSION_SUFFIX[compression]}"
+        task_list.append((in_path_str, str(out_path), table_name, schema0, postgres_type_list0, converter, output_format))
 
-            ddl_queue = deque()
-            postgres_type_list = make_sql_create_table(table_name, schema["fields"], ddl_queue,
-                                                       postgres_record_type_prefix)
+    # 前回から変わっていないパーティションはスキップする（DDLのスキーマが変わったら、古いAvroファイルも新しい列で出力し直す）
+    manifest = read_manifest(manifest_path)
+    if manifest_path is not None:
+        changed_task_list = []
+        for task in task_list:
+            entry = manifest["partitions"].get(task[2], {}).get("avro_to_sql")
+            if entry is not None and entry.get("state") == "done" and entry.get("source") == source_identity_dict[task[0]] \
+                    and entry.get("output") == output_options and entry.get("schema", "nested") == schema_mode \
+                    and entry.get("projection") == projection \
+                    and entry.get("fingerprint", schema_plan["fingerprint"]) == schema_plan["fingerprint"] \
+                    and all([output_unchanged(manifest, path_str) for path_str in
+                             [task[1]] + [child_out_path(task[1], task[2], child_name) for child_name in child_name_list]]):
+                print(f"skip:\n    unchanged: {task[0]}")
+                continue
+            changed_task_list.append(task)
+        task_list = changed_task_list
+        print(f"変換するAvroファイル数：{len(task_list)}")
 
-            # トランザクション開始
-            fo.write("BEGIN;\n")
+    # 形式・圧縮を変えた場合は、同じパーティションの前回の出力ファイルを消す
+    for task in task_list:
+        for out_path_str in [task[1]] + [child_out_path(task[1], task[2], child_name) for child_name in child_name_list]:
+            for stale_path in stale_output_paths(out_path_str):
+                print(f"remove:\n    {stale_path}")
+                stale_path.unlink()
 
-            # INSERT文
-            num = 0
-            for rec in reader:
-                num += 1
-                insert_stmt = make_sql_insert(table_name, schema, postgres_type_list, rec, null_if_convert_error=False)
-                fo.write(insert_stmt)
-                if num % COMMIT_NUM == 0:
-                    fo.write("COMMIT;\nBEGIN;\n")
-            print(f"({index}) {table_name}.sql: {num} 行")
+    escape_counts = [0, 0]
+
+    def finish_partition(index, task, result, note=""):
+        num = result["rows"]
+        escape_counts[0] += result["escape_hits"]
+        escape_counts[1] += result["escape_misses"]
+        child_note = f"（子テーブル {result['child_rows']} 行）" if 0 < len(child_name_list) else ""
+        filtered_note = f"（除いた行 {result['filtered_rows']} 行）" if 0 < len(event_names) else ""
+        print(f"({index}) {Path(task[1]).name}: {num} 行{child_note}{filtered_note}, {result['seconds']:.1f} 秒{note}")
+        child_path_list = [child_out_path(task[1], task[2], child_name) for child_name in child_name_list]
+        source_identity = source_identity_dict.get(task[0]) or avro_source_identity(task[0])
+        metrics.record(task[2], result["seconds"], rows=num, bytes_in=source_identity["size"],
+                       bytes_out=sum([Path(path_str).stat().st_size for path_str in [task[1]] + child_path_list]),
+                       decode_seconds=result["decode_seconds"], convert_seconds=result["convert_seconds"],
+                       filtered_rows=result["filtered_rows"])
+        if manifest_path is not None:
+            manifest["partitions"].setdefault(task[2], {})["avro_to_sql"] = {
+                "state": "done",
+                "source": source_identity,
+                "format": output_format,
+                "output": output_options,
+                "schema": schema_mode,
+                "projection": projection,
+                "fingerprint": schema_plan["fingerprint"],
+                "path": task[1],
+                "size": Path(task[1]).stat().st_size,
+                "rows": num,
+            }
+            # 子テーブルのファイルも、(3)がパーティションとしてロードする
+            for child_path_str in child_path_list:
+                manifest["partitions"].setdefault(output_partition_name(child_path_str), {})["avro_to_sql"] = {
+                    "state": "done",
+                    "parent": task[2],
+                    "path": child_path_str,
+                    "size": Path(child_path_str).stat().st_size,
+                }
+            write_manifest(manifest_path, manifest)
+
+    def partition_head_list(task):
+        # 分割して変換した場合に連結する、出力ファイル（eventsと子テーブル）とその先頭
+        out_list = [(task[1], make_partition_head(output_format, task[2], schema0, postgres_type_list0))]
+        for child in schema_plan["child_list"]:
+            out_list.append((child_out_path(task[1], task[2], child["name"]),
+                             make_partition_head(output_format, make_child_table_name(child["name"], task[2]),
+                                                 child["schema"], child["postgres_type_list"])))
+        return out_list
+
+    # 大きなAvroファイルはブロック単位で分割する
+    chunk_list_list = []
+    for task in task_list:
+        if 1 < workers and 0 < split_size and not task[0].startswith("gs://") and split_size < os.path.getsize(task[0]):
+            chunk_list_list.append(split_avro_blocks(task[0], split_size))
+        else:
+            chunk_list_list.append(None)
+
+    try:
+        if workers == 1:
+            for index, task in enumerate(task_list, 1):
+                result = convert_func(*task, read_ahead=read_ahead, reader_schema=reader_schema_dict.get(task[0]))
+                finish_partition(index, task, result)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                future_list = []
+                for task, chunk_list in zip(task_list, chunk_list_list):
+                    if chunk_list is None:
+                        future_list.append(executor.submit(convert_func, *task, read_ahead=read_ahead,
+                                                           reader_schema=reader_schema_dict.get(task[0])))
+                    else:
+                        future_list.append([
+                            executor.submit(convert_func, task[0], f"{task[1]}.part{n}", *task[2:], chunk=chunk,
+                                            reader_schema=reader_schema_dict.get(task[0]))
+                            for n, chunk in enumerate(chunk_list, 1)])
+                try:
+                    # 進捗はファイルの順番どおりに表示する
+                    for index, (task, future) in enumerate(zip(task_list, future_list), 1):
+                        if type(future) is list:
+                            result_list = [chunk_future.result() for chunk_future in future]
+                            result = {key: sum([chunk_result[key] for chunk_result in result_list]) for key in result_list[0]}
+                            for out_path_str, partition_head in partition_head_list(task):
+                                join_partition_chunks(out_path_str, [f"{out_path_str}.part{n}" for n in range(1, len(future) + 1)], task[6],
+                                                      compression, compression_level, partition_head)
+                            finish_partition(index, task, result, f"（{len(future)}分割）")
+                        else:
+                            result = future.result()
+                            finish_partition(index, task, result)
+                except Exception:
+                    for future in future_list:
+                        for chunk_future in (future if type(future) is list else [future]):
+                            chunk_future.cancel()
+                    raise
+    except Exception:
+        metrics.record_error()
+        raise
+    finally:
+        metrics.write_prometheus()
 
-            # トランザクション終了
-            fo.write("COMMIT;\n")
+    if 0 < escape_counts[0] + escape_counts[1]:
+        print(f"escape()のキャッシュ：ヒット {escape_counts[0]} 回, ミス {escape_counts[1]} 回, "
+              f"ヒット率 {escape_counts[0] / (escape_counts[0] + escape_counts[1]):.1%}")
 
 
 if __name__ == "__main__":
@@ -389,3 +1887,4 @@ if __name__ == "__main__":
         main()
     except Exception:
         print(traceback.format_exc())
+        sys.exit(1)
@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+import ga4_from_avro_to_sql as avro_to_sql
+
+VALUE = {"type": "record", "name": "Value", "fields": [
+    {"name": "string_value", "type": ["null", "string"], "default": None},
+    {"name": "int_value", "type": ["null", "long"], "default": None},
+]}
+PARAM = {"type": "record", "name": "Param", "fields": [
+    {"name": "key", "type": ["null", "string"], "default": None},
+    {"name": "value", "type": ["null", VALUE], "default": None},
+]}
+SCHEMA = {"type": "record", "name": "Root", "fields": [
+    {"name": "event_params", "type": {"type": "array", "items": PARAM}},
+]}
+REC = {"event_params": [
+    {"key": 'a"b', "value": {"string_value": "c\\d", "int_value": 1}},
+    {"key": "e", "value": None},
+]}
+# 配列の値（COPYのエスケープ前）。入れ子の要素は、外側の要素のクォートの中でさらにエスケープされる
+ARRAY_TEXT = r'{"(\"a\\\"b\",\"(\\\"c\\\\\\\\d\\\",\\\"1\\\")\")","(\"e\",)"}'
+
+
+def test_copy_row_escapes_nested_elements():
+    postgres_type_list = avro_to_sql.make_sql_create_table("events", SCHEMA["fields"], [], "events_")
+    for maxsize in (0, 16):
+        avro_to_sql.set_escape_cache_size(maxsize)
+        for null_if_convert_error in (False, True):
+            make_row = avro_to_sql.compile_copy_row(SCHEMA, postgres_type_list, null_if_convert_error)
+            assert make_row(REC) == ARRAY_TEXT.replace("\\", "\\\\") + "\n"
+    avro_to_sql.set_escape_cache_size(avro_to_sql.ESCAPE_CACHE_SIZE)
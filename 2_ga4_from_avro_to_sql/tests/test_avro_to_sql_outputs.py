@@ -0,0 +1,16 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+import ga4_from_avro_to_sql as avro_to_sql
+
+
+def test_stale_output_paths_finds_other_formats_and_compression(tmp_path):
+    for name in ("events_20221101.sql", "events_20221101.sql.gz", "events_20221101.copy.zst", "events_20221102.sql",
+                 "event_params_20221101.sql"):
+        (tmp_path / name).write_text("", encoding="utf-8")
+    out_path_str = str(tmp_path / "events_20221101.sql.gz")
+    assert sorted([path.name for path in avro_to_sql.stale_output_paths(out_path_str)]) == \
+        ["events_20221101.copy.zst", "events_20221101.sql"]
+    assert avro_to_sql.stale_output_paths(str(tmp_path / "events_20221102.sql")) == []
@@ -0,0 +1,59 @@
+import sys
+import configparser
+from pathlib import Path
+import fastavro
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+import ga4_from_avro_to_sql as avro_to_sql
+
+SCHEMA = {
+    "type": "record",
+    "name": "Root",
+    "fields": [
+        {"name": "event_date", "type": ["null", "string"], "default": None},
+        {"name": "event_timestamp", "type": ["null", "long"], "default": None},
+        {"name": "event_name", "type": ["null", "string"], "default": None},
+        {"name": "user_id", "type": ["null", "string"], "default": None},
+    ],
+}
+
+
+def make_config(columns, event_names):
+    config = configparser.ConfigParser()
+    config.read_dict({"projection": {"columns": columns, "event_names": event_names}})
+    return config
+
+
+def test_read_projection_keeps_event_name_when_filtering():
+    columns, event_names = avro_to_sql.read_projection(make_config("event_timestamp", "page_view"))
+    assert columns == ("event_date", "event_timestamp", "event_name")
+    assert event_names == ("page_view",)
+
+
+def test_read_projection_without_event_names():
+    columns, event_names = avro_to_sql.read_projection(make_config("event_timestamp", ""))
+    assert columns == ("event_date", "event_timestamp")
+    assert event_names == ()
+
+
+def test_convert_partition_filters_projected_avro(tmp_path):
+    # (1)で columns = event_timestamp, event_names = page_view として抽出したAvroファイル
+    # （event_dateとevent_nameは(1)が必ず残す）
+    schema = avro_to_sql.make_projected_schema(SCHEMA, ("event_date", "event_timestamp", "event_name"))
+    in_path = tmp_path / "202211" / "events_20221101.avro"
+    in_path.parent.mkdir()
+    rec_list = [{"event_date": "20221101", "event_timestamp": 1667260800000000 + num, "event_name": event_name}
+                for num, event_name in enumerate(["page_view", "scroll", "page_view"])]
+    with open(in_path, "wb") as fo:
+        fastavro.writer(fo, fastavro.parse_schema(schema), rec_list)
+
+    columns, event_names = avro_to_sql.read_projection(make_config("event_timestamp", "page_view, scroll2"))
+    schema_plan = avro_to_sql.make_schema_plan([str(in_path)], "events", columns=columns)
+    out_path = tmp_path / "events_20221101.copy"
+    result = avro_to_sql.convert_partition(str(in_path), str(out_path), "events_20221101", schema_plan["schema"],
+                                           schema_plan["postgres_type_list"], "compiled", "copy", event_names=event_names)
+    assert result["rows"] == 2
+    assert result["filtered_rows"] == 1
+    line_list = out_path.read_text(encoding="utf-8").splitlines()
+    assert [line.split("\t")[-1] for line in line_list] == ["page_view", "page_view"]
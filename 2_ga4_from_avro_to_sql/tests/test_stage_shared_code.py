@@ -0,0 +1,25 @@
+import ast
+from pathlib import Path
+
+# 各ステージのイメージは自分のディレクトリだけをビルドコンテキストにするので、
+# マニフェストと処理時間の記録のコードは3つのスクリプトに同じものを置いている
+ROOT = Path(__file__).resolve().parent.parent.parent
+SCRIPT_LIST = ["1_ga4_from_bq_to_avro/deploy/ga4_from_bq_to_avro.py",
+               "2_ga4_from_avro_to_sql/deploy/ga4_from_avro_to_sql.py",
+               "3_ga4_from_sql_to_postgres/deploy/ga4_from_sql_to_postgres.py"]
+SHARED_NAMES = ("read_manifest", "write_manifest", "StageMetrics", "open_stage_metrics")
+
+
+def read_definitions(path):
+    # 読み込み（google-cloud等）をせずに、トップレベルの関数・クラスのソースを取り出す
+    source = path.read_text(encoding="utf-8")
+    return {node.name: ast.get_source_segment(source, node) for node in ast.parse(source).body
+            if isinstance(node, (ast.FunctionDef, ast.ClassDef))}
+
+
+def test_shared_code_is_identical_in_all_stages():
+    definitions_list = [read_definitions(ROOT / script) for script in SCRIPT_LIST]
+    for name in SHARED_NAMES:
+        source_list = [definitions.get(name) for definitions in definitions_list]
+        assert None not in source_list, name
+        assert len(set(source_list)) == 1, f"{name} differs between stages"
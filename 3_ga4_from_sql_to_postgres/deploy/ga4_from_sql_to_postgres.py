@@ -1,8 +1,26 @@
+import sys
+import os
+import time
+import re
+import io
+import gzip
+import json
+import datetime
+import threading
 import traceback
 from pathlib import Path
 import glob
 import configparser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import psycopg2
+import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
+
+LOAD_SCHEMA = "ga4_load"
+LOAD_MODES = ("attached", "detached")
+COMPRESSION_SUFFIXES = (".gz", ".zst")
+FILE_FORMATS = {".sql": "insert", ".copy": "copy", ".prep": "prepared"}
+COPY_UNESCAPE_LIST = [("\\t", "\t"), ("\\n", "\n"), ("\\r", "\r"), ("\\b", "\b"), ("\\f", "\f"), ("\\v", "\v")]
 
 
 class MyException(Exception):
@@ -15,6 +33,352 @@ def read_config(config_path):
     return config
 
 
+def iter_sql_batches(fi, batch_size):
+    # INSERTファイルを文の終わり（「;」で終わる行）で区切り、batch_size文字程度ずつ返す（ファイル全体をメモリに読み込まない）
+    # パーティション全体が1つのトランザクションでも、文の途中でなければ区切ってよい
+    # 文字列リテラル内の「;」で区切らないよう、シングルクォートの数の偶奇を数える
+    batch = []
+    size = 0
+    in_literal = False
+    for line in fi:
+        batch.append(line)
+        size += len(line)
+        if line.count("'") % 2 == 1:
+            in_literal = not in_literal
+        if not in_literal and line.endswith(";\n") and batch_size <= size:
+            yield "".join(batch)
+            batch = []
+            size = 0
+    if 0 < len(batch):
+        yield "".join(batch)
+
+
+def split_compression_suffix(in_path_str):
+    # (圧縮の拡張子を除いたファイル名, 圧縮の拡張子) を返す（events_YYYYMMDD.copy.zst -> events_YYYYMMDD.copy, .zst）
+    name = Path(in_path_str).name
+    for suffix in COMPRESSION_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)], suffix
+    return name, ""
+
+
+def partition_name(in_path_str):
+    # INSERTファイル／COPYファイル／preparedファイルのパーティション名（= テーブル名）
+    return Path(split_compression_suffix(in_path_str)[0]).stem
+
+
+def file_format(in_path_str):
+    # insert / copy / prepared（(2)のconvert.format）
+    return FILE_FORMATS[Path(split_compression_suffix(in_path_str)[0]).suffix]
+
+
+def unescape_copy_value(field):
+    # COPYのテキスト形式のエスケープを戻す（複合型の値は入れ子の \\ を多く含むので、正規表現を使わない）
+    # PostgreSQLの文字列はNUL（\x00）を含まないので、エスケープした \ の目印に使う
+    field = field.replace("\\\\", "\x00")
+    if "\\" in field:
+        for escaped, char in COPY_UNESCAPE_LIST:
+            field = field.replace(escaped, char)
+        # それ以外の「\文字」はその文字
+        field = field.replace("\\", "")
+    return field.replace("\x00", "\\")
+
+
+def parse_copy_row(line):
+    # COPYのテキスト形式の1行を値のリストにする（\N は None）
+    return [None if field == "\\N" else unescape_copy_value(field) if "\\" in field else field
+            for field in line.rstrip("\n").split("\t")]
+
+
+def execute_prepared(cur, fi, table_name, page_rows):
+    # preparedファイル（1行目がパラメーター付きのINSERT文、2行目以降がパラメーターの行）を実行し、行数を返す
+    # INSERT文は1回だけPREPAREし、page_rows行分の「EXECUTE 文 (値, ...)」をまとめて送信する（1行ごとに往復しない）
+    # psycopg2は値をクライアント側でリテラルにして送るので、サーバーはEXECUTE文ごとに解析する
+    # （使い回されるのはINSERT文の解析・計画だけで、バインドパラメーターでの送信ではない）
+    statement_name = f"{table_name}_insert"
+    statement = fi.readline()
+    # PREPAREした文はロールバックしても残るので、失敗して再実行する場合は作り直す
+    cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s", (statement_name,))
+    if cur.fetchone() is not None:
+        cur.execute(f"DEALLOCATE {statement_name}")
+    cur.execute(f"PREPARE {statement_name} AS {statement}")
+    counts = {"rows": 0}
+
+    def iter_rows():
+        for line in fi:
+            counts["rows"] += 1
+            yield parse_copy_row(line)
+
+    param_count = len(re.findall(r"\$\d+", statement))
+    psycopg2.extras.execute_batch(cur, f"EXECUTE {statement_name} ({', '.join(['%s'] * param_count)})", iter_rows(),
+                                  page_size=page_rows)
+    cur.execute(f"DEALLOCATE {statement_name}")
+    return counts["rows"]
+
+
+def open_sql_file(in_path_str):
+    # INSERTファイル／COPYファイルをテキストモードで開く。.gz / .zst なら読みながら展開する（ファイル全体を展開しない）
+    suffix = split_compression_suffix(in_path_str)[1]
+    if suffix == "":
+        return open(in_path_str, "rt", encoding="utf-8")
+    elif suffix == ".gz":
+        return gzip.open(in_path_str, "rt", encoding="utf-8")
+    else:
+        # zstdを使うときだけzstandardを読み込む
+        # (2)は分割して変換した部分を別々のフレームのまま連結するので、フレームをまたいで読む
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(open(in_path_str, "rb"), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(io.BufferedReader(reader), encoding="utf-8")
+
+
+def load_partition(conn, in_path_str, batch_size, truncate=False, page_rows=1000):
+    # 1パーティション分のINSERTファイル／COPYファイル／preparedファイルを実行し、行数を返す
+    table_name = partition_name(in_path_str)
+    with conn.cursor() as cur:
+        if truncate:
+            cur.execute(f"TRUNCATE {table_name}")
+        with open_sql_file(in_path_str) as fi:
+            if file_format(in_path_str) == "copy":
+                cur.copy_expert(f"COPY {table_name} FROM STDIN", fi)
+                rows = cur.rowcount
+            elif file_format(in_path_str) == "prepared":
+                rows = execute_prepared(cur, fi, table_name, page_rows)
+            else:
+                for sql in iter_sql_batches(fi, batch_size):
+                    cur.execute(sql)
+                cur.execute(f"SELECT count(*) FROM {table_name}")
+                rows = cur.fetchone()[0]
+    conn.commit()
+    return rows
+
+
+def load_partition_detached(conn, in_path_str, batch_size, partition_stmt, unlogged=False, page_rows=1000):
+    # 1パーティション分を親テーブル（events、子テーブル）とは別のテーブル（スキーマ LOAD_SCHEMA）にロードし、
+    # CHECK制約の追加・ANALYZEの後でATTACHする
+    # 既にパーティションがあれば、DETACH・DROPと新しいテーブルのATTACHを1つのトランザクションで行う（入れ替え）
+    # unlogged=TrueならUNLOGGEDテーブルにロードし、ATTACHの前にLOGGEDに戻す
+    table_name = partition_name(in_path_str)
+    parent_table_name = table_name.rsplit("_", 1)[0]
+    load_table_name = f"{LOAD_SCHEMA}.{table_name}"
+    date_from, date_to = re.search(r"FOR VALUES FROM \('(\d+)'\) TO \('(\d+)'\)", partition_stmt).groups()
+    check_name = f"{table_name}_event_date_check"
+    with conn.cursor() as cur:
+        # 同じトランザクションで作成したテーブルへのCOPYは、wal_level = minimal ならWALを書かない
+        cur.execute(f"DROP TABLE IF EXISTS {load_table_name}")
+        cur.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {load_table_name} (LIKE {parent_table_name} INCLUDING DEFAULTS)")
+
+        # INSERTファイル／COPYファイル／preparedファイルのテーブル名はスキーマを省略しているので、LOAD_SCHEMAを先に探させる
+        # （INSERTファイルにはCOMMITが含まれるので、SET LOCALではなくセッションに設定し、失敗しても必ず戻す）
+        try:
+            cur.execute(f"SET search_path TO {LOAD_SCHEMA}, public")
+            with open_sql_file(in_path_str) as fi:
+                if file_format(in_path_str) == "copy":
+                    cur.copy_expert(f"COPY {table_name} FROM STDIN", fi)
+                    rows = cur.rowcount
+                elif file_format(in_path_str) == "prepared":
+                    rows = execute_prepared(cur, fi, table_name, page_rows)
+                else:
+                    for sql in iter_sql_batches(fi, batch_size):
+                        cur.execute(sql)
+                    cur.execute(f"SELECT count(*) FROM {load_table_name}")
+                    rows = cur.fetchone()[0]
+        except Exception:
+            if conn.closed == 0:
+                conn.rollback()
+                cur.execute("RESET search_path")
+                conn.commit()
+            raise
+        cur.execute("RESET search_path")
+        conn.commit()
+
+        # パーティションの範囲と同じCHECK制約があれば、ATTACHのときにテーブル全体を検査しない
+        cur.execute(f"ALTER TABLE {load_table_name} ADD CONSTRAINT {check_name} "
+                    f"CHECK (event_date IS NOT NULL AND event_date >= '{date_from}' AND event_date < '{date_to}')")
+        cur.execute(f"ANALYZE {load_table_name}")
+        if unlogged:
+            cur.execute(f"ALTER TABLE {load_table_name} SET LOGGED")
+        conn.commit()
+
+        cur.execute("SELECT to_regclass(%s)", (f"public.{table_name}",))
+        if cur.fetchone()[0] is not None:
+            cur.execute(f"ALTER TABLE {parent_table_name} DETACH PARTITION public.{table_name}")
+            cur.execute(f"DROP TABLE public.{table_name}")
+        cur.execute(f"ALTER TABLE {load_table_name} SET SCHEMA public")
+        cur.execute(f"ALTER TABLE {parent_table_name} ATTACH PARTITION public.{table_name} FOR VALUES FROM ('{date_from}') TO ('{date_to}')")
+        cur.execute(f"ALTER TABLE public.{table_name} DROP CONSTRAINT {check_name}")
+    conn.commit()
+    return rows
+
+
+def load_partition_with_retry(conn_pool, in_path_str, batch_size, retries, truncate=False, partition_stmt=None,
+                              unlogged=False, page_rows=1000):
+    # (行数, 秒数, エラー)を返す（秒数は再実行を含む）。失敗したらそのパーティションだけを空にして再実行する
+    # truncate=Trueなら1回目も空にしてからロードする（前回ロード済みのパーティションの入れ替え）
+    # partition_stmtを指定すると、別のテーブルにロードしてからATTACHする（load_partition_detached()）
+    error = None
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        if 0 < attempt:
+            print(f"retry({attempt}/{retries}): {in_path_str}\n    {str(error).strip()}")
+        conn = conn_pool.getconn()
+        try:
+            if partition_stmt is None:
+                rows = load_partition(conn, in_path_str, batch_size, truncate=(truncate or 0 < attempt), page_rows=page_rows)
+            else:
+                rows = load_partition_detached(conn, in_path_str, batch_size, partition_stmt, unlogged=unlogged,
+                                               page_rows=page_rows)
+        except Exception as e:
+            error = e
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            conn_pool.putconn(conn, close=(conn.closed != 0))
+        else:
+            conn_pool.putconn(conn)
+            return rows, time.perf_counter() - start, None
+    return None, time.perf_counter() - start, error
+
+
+def sql_file_identity(in_path_str):
+    # 前回のロード時から変わったかどうかを判定するための、ファイルの大きさと更新日時
+    stat = os.stat(in_path_str)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def select_load_files(sql_list, manifest, events_exists):
+    # (ロードするファイルのリスト, 変換が終わっていないファイルのリスト)を返す
+    # eventsテーブルがなければ（データベース・テーブルを作り直した等）、ロード済みの記録は使わずにすべてロードする
+    load_list = []
+    incomplete_list = []
+    for in_path_str in sql_list:
+        entry_dict = manifest["partitions"].get(partition_name(in_path_str), {})
+        entry = entry_dict.get("sql_to_postgres")
+        if entry is not None and entry.get("state") == "done" and entry.get("source") == sql_file_identity(in_path_str):
+            if events_exists:
+                print(f"skip:\n    unchanged: {in_path_str}")
+                continue
+            print(f"reload:\n    events not found: {in_path_str}")
+        entry = entry_dict.get("avro_to_sql")
+        if entry is not None and (entry.get("state") != "done" or entry.get("size") != os.path.getsize(in_path_str)):
+            print(f"skip:\n    incomplete: {in_path_str}")
+            incomplete_list.append(in_path_str)
+            continue
+        load_list.append(in_path_str)
+    return load_list, incomplete_list
+
+
+def read_manifest(manifest_path):
+    # 3つのステージで共有する、パーティションごとの処理状況
+    if manifest_path is None or not manifest_path.exists():
+        return {"partitions": {}}
+    with open(manifest_path, "rt", encoding="utf-8") as fi:
+        return json.load(fi)
+
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, "wt", encoding="utf-8") as fo:
+        json.dump(manifest, fo, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+class StageMetrics:
+    # パーティションごとの処理時間・行数・バイト数を、JSON Lines と Prometheus の textfile に書き出す
+    # （どちらもパスの指定がなければ書き出さない）
+    def __init__(self, stage, jsonl_path=None, prometheus_path=None):
+        self.stage = stage
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.record_list = []
+        self.error_count = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, partition, seconds, rows=None, bytes_in=None, bytes_out=None, **extra):
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "stage": self.stage,
+            "partition": partition,
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "rows_per_sec": round(rows / seconds, 1) if rows is not None and 0 < seconds else None,
+        }
+        record.update({key: round(value, 3) if type(value) is float else value for key, value in extra.items()})
+        with self.lock:
+            self.record_list.append(record)
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, "at", encoding="utf-8") as fo:
+                    fo.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def record_error(self):
+        with self.lock:
+            self.error_count += 1
+
+    def write_prometheus(self):
+        # node_exporterのtextfileコレクターが書きかけのファイルを読まないように、一時ファイルから名前を変える
+        if self.prometheus_path is None:
+            return
+        # 同じパーティションを複数回記録した場合は最後の値を使う
+        latest_dict = {record["partition"]: record for record in self.record_list}
+        value_dict = {}
+        for record in latest_dict.values():
+            for key, value in record.items():
+                if key not in ("time", "stage", "partition") and type(value) in (int, float):
+                    value_dict.setdefault(key, []).append((record["partition"], value))
+        lines = []
+        for key, value_list in value_dict.items():
+            name = f"ga4_partition_{key.replace('_per_sec', '_per_second')}"
+            lines.append(f"# TYPE {name} gauge\n")
+            for partition, value in value_list:
+                lines.append(f'{name}{{stage="{self.stage}",partition="{partition}"}} {value}\n')
+        for name, value in (("ga4_stage_partitions", len(latest_dict)),
+                            ("ga4_stage_errors", self.error_count),
+                            ("ga4_stage_rows", sum([record["rows"] or 0 for record in latest_dict.values()])),
+                            ("ga4_stage_seconds", round(time.time() - self.start, 3)),
+                            ("ga4_stage_last_run_timestamp_seconds", round(time.time(), 3))):
+            lines.append(f"# TYPE {name} gauge\n")
+            lines.append(f'{name}{{stage="{self.stage}"}} {value}\n')
+        tmp_path = self.prometheus_path.with_name(self.prometheus_path.name + ".tmp")
+        with open(tmp_path, "wt", encoding="utf-8") as fo:
+            fo.writelines(lines)
+        os.replace(tmp_path, self.prometheus_path)
+
+
+def open_stage_metrics(config, stage):
+    # [metrics] jsonl_path / prometheus_path（指定がなければ書き出さない）
+    path_list = []
+    for key in ("jsonl_path", "prometheus_path"):
+        path_str = config.get("metrics", key, fallback="")
+        path_list.append(Path.cwd() / path_str if path_str != "" else None)
+    return StageMetrics(stage, *path_list)
+
+
+def find_partition_stmt(ddl, table_name):
+    # DDLファイルから「CREATE TABLE events_YYYYMMDD PARTITION OF events ...」（子テーブルのパーティションも同様）を取り出す
+    for stmt in ddl.split(";\n"):
+        if stmt.startswith(f"CREATE TABLE {table_name}\n"):
+            return stmt + ";\n"
+    raise MyException(f"DDLファイルにパーティションがありません：{table_name}")
+
+
+def remove_partition_stmts(ddl):
+    # DDLファイルから「CREATE TABLE events_YYYYMMDD PARTITION OF events ...」を除く（load_mode = detached ではロード後に作成する）
+    return "".join([stmt + ";\n" for stmt in ddl.split(";\n")
+                    if stmt.strip() != "" and "\n    PARTITION OF " not in stmt])
+
+
+def find_partitioned_tables(ddl):
+    # DDLファイルのパーティションを持つテーブル（events、schema = normalized なら子テーブルも）
+    table_name_list = []
+    for table_name in re.findall(r"\n    PARTITION OF (\w+)\n", ddl):
+        if table_name not in table_name_list:
+            table_name_list.append(table_name)
+    return table_name_list
+
+
 def main():
     config_path = Path.cwd() / "ga4_from_sql_to_postgres.ini"
     config = read_config(config_path)
@@ -25,32 +389,151 @@ def main():
     if len(ddl_list) != 1:
         raise MyException(f"DDLファイルは1つでなければなりません。処理を中断します。")
 
-    sql_list = glob.glob(str(local_in_home) + "/*/events_*.sql")
+    with open(ddl_list[0], "rt", encoding="utf-8") as fi:
+        sql = fi.read()
+
+    # 前回のDDLから列・属性が追加されていれば、(2)が出力するALTER文（eventsテーブルが既にあるときに実行する）
+    alter_sql = None
+    alter_list = glob.glob(str(local_in_home) + "/events_*_alter.sql")
+    if 0 < len(alter_list):
+        with open(alter_list[0], "rt", encoding="utf-8") as fi:
+            alter_sql = fi.read()
+
+    # schema = normalized なら、子テーブルのファイル（event_params_YYYYMMDD.sql等）もパーティションとしてロードする
+    # 圧縮したファイル（*.sql.gz、*.copy.zst等）も読む
+    sql_list = []
+    copy_list = []
+    prep_list = []
+    for table_name in find_partitioned_tables(sql):
+        for suffix in ("",) + COMPRESSION_SUFFIXES:
+            sql_list += glob.glob(str(local_in_home) + f"/*/{table_name}_*.sql{suffix}")
+            copy_list += glob.glob(str(local_in_home) + f"/*/{table_name}_*.copy{suffix}")
+            prep_list += glob.glob(str(local_in_home) + f"/*/{table_name}_*.prep{suffix}")
     print(f"INSERTファイル数：{len(sql_list)}")
+    print(f"COPYファイル数：{len(copy_list)}")
+    if 0 < len(prep_list):
+        print(f"preparedファイル数：{len(prep_list)}")
+    sql_list += copy_list + prep_list
     sql_list.sort(reverse=True)
 
+    # 同じパーティションのファイルが複数（INSERT/COPY/preparedの違い、圧縮の有無の違い）あると二重にロードされる
+    partition_list = [partition_name(in_path_str) for in_path_str in sql_list]
+    if len(partition_list) != len(set(partition_list)):
+        raise MyException(f"同じパーティションのファイル（INSERT/COPY/prepared、圧縮の有無）が混在しています。処理を中断します。")
+
     host = config["postgresql"]["host"]
     port = config["postgresql"]["port"]
     dbname = config["postgresql"]["dbname"]
     user = config["postgresql"]["user"]
     password = config["postgresql"]["password"]
 
-    with psycopg2.connect(f"host={host} port={port} dbname={dbname} user={user} password={password}") as conn:
+    # 同時に使う接続数と、失敗したパーティションを再実行する回数
+    connections = config.getint("postgresql", "connections", fallback=1)
+    retries = config.getint("postgresql", "retries", fallback=0)
+    if connections < 1:
+        raise MyException(f"postgresql.connectionsの値が不正です：{connections}")
+
+    # INSERTファイルを1回に送信する大きさ(MB)
+    batch_size = config.getint("postgresql", "batch_mb", fallback=16) * 1024 * 1024
+    # preparedファイルのEXECUTEを1回に送信する行数
+    page_rows = config.getint("postgresql", "page_rows", fallback=1000)
+    if page_rows < 1:
+        raise MyException(f"postgresql.page_rowsの値が不正です：{page_rows}")
+
+    # パーティションへのロード方法（attached: eventsのパーティションに直接ロードする、detached: 別のテーブルにロードしてからATTACHする）
+    load_mode = config.get("postgresql", "load_mode", fallback="attached")
+    if load_mode not in LOAD_MODES:
+        raise MyException(f"postgresql.load_modeの値が不正です：{load_mode}")
+    # load_mode = detached のとき、UNLOGGEDテーブルにロードする
+    unlogged = config.getboolean("postgresql", "unlogged", fallback=False)
+
+    # 処理状況を記録するファイル（指定がなければ記録しない）
+    manifest_path = None
+    if config.has_option("manifest", "path"):
+        manifest_path = Path.cwd() / config["manifest"]["path"]
+    manifest = read_manifest(manifest_path)
+
+    # パーティションごとの処理時間・行数・バイト数
+    metrics = open_stage_metrics(config, "sql_to_postgres")
+
+    error_list = []
+    dsn = f"host={host} port={port} dbname={dbname} user={user} password={password}"
+    with psycopg2.connect(dsn) as conn:
         with conn.cursor() as cur:
-            print(f"DDLを実行します")
-            with open(ddl_list[0], "rt", encoding="utf-8") as fi:
-                sql = fi.read()
+            cur.execute("SELECT to_regclass('events')")
+            events_exists = cur.fetchone()[0] is not None
+            incremental = manifest_path is not None and events_exists
+
+            # 前回から変わっていないパーティションはスキップする。変換が終わっていないファイルはロードしない
+            if manifest_path is not None:
+                sql_list, error_list = select_load_files(sql_list, manifest, events_exists)
+                print(f"ロードするファイル数：{len(sql_list)}")
+
+            if events_exists and alter_sql is not None:
+                print(f"追加された列・属性を既存のテーブルに加えます")
+                cur.execute(alter_sql)
+            if load_mode == "detached":
+                # パーティションはロードの後でATTACHする
+                if not events_exists:
+                    print(f"DDLを実行します")
+                    cur.execute(remove_partition_stmts(sql))
+                cur.execute(f"CREATE SCHEMA IF NOT EXISTS {LOAD_SCHEMA}")
+            elif incremental:
+                # eventsテーブルが既にあれば、足りないパーティションだけを作成する
+                print(f"パーティションを作成します")
+                for in_path_str in sql_list:
+                    table_name = partition_name(in_path_str)
+                    cur.execute("SELECT to_regclass(%s)", (table_name,))
+                    if cur.fetchone()[0] is None:
+                        cur.execute(find_partition_stmt(sql, table_name))
+            else:
+                print(f"DDLを実行します")
                 cur.execute(sql)
             print("  ... done.")
+    conn.close()
 
-            print(f"INSERT文を実行します")
+    print(f"INSERT文／COPYを実行します（接続数：{connections}, {load_mode}）")
+    conn_pool = ThreadedConnectionPool(1, connections, dsn)
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            future_dict = {}
             for index, in_path_str in enumerate(sql_list, 1):
-                in_path = Path(in_path_str)
-                print(f"({index}) パーティション: {in_path.stem}:\n    {in_path_str} ... ", end="")
-                with open(in_path, "rt", encoding="utf-8") as fi:
-                    sql = fi.read()
-                    cur.execute(sql)
-                print("done.")
+                partition_stmt = find_partition_stmt(sql, partition_name(in_path_str)) if load_mode == "detached" else None
+                future = executor.submit(load_partition_with_retry, conn_pool, in_path_str, batch_size, retries, incremental,
+                                         partition_stmt, unlogged, page_rows)
+                future_dict[future] = (index, in_path_str)
+            for future in as_completed(future_dict):
+                index, in_path_str = future_dict[future]
+                rows, seconds, error = future.result()
+                if error is None:
+                    print(f"({index}) パーティション: {partition_name(in_path_str)}: {rows} 行, {seconds:.1f} 秒\n    {in_path_str}")
+                    entry = {"state": "done", "source": sql_file_identity(in_path_str), "rows": rows, "seconds": round(seconds, 3)}
+                    metrics.record(partition_name(in_path_str), seconds, rows=rows, bytes_in=os.path.getsize(in_path_str))
+                else:
+                    print(f"({index}) パーティション: {partition_name(in_path_str)}: 失敗, {seconds:.1f} 秒\n    {in_path_str}\n    {str(error).strip()}")
+                    error_list.append(in_path_str)
+                    metrics.record_error()
+                    entry = {"state": "failed", "source": sql_file_identity(in_path_str), "error": str(error).strip()}
+                if manifest_path is not None:
+                    manifest["partitions"].setdefault(partition_name(in_path_str), {})["sql_to_postgres"] = entry
+                    write_manifest(manifest_path, manifest)
+    finally:
+        conn_pool.closeall()
+        metrics.write_prometheus()
+
+    # 索引と拡張統計はロードの後で作成する（schema = normalized のとき、(2)が出力する）
+    index_list = glob.glob(str(local_in_home) + "/events_*_index.sql")
+    if 0 < len(index_list):
+        print(f"索引と統計を作成します")
+        with psycopg2.connect(dsn) as conn:
+            with conn.cursor() as cur:
+                with open(index_list[0], "rt", encoding="utf-8") as fi:
+                    cur.execute(fi.read())
+        conn.close()
+        print("  ... done.")
+
+    if 0 < len(error_list):
+        raise MyException(f"ロードに失敗したパーティションがあります：{len(error_list)}件\n    " + "\n    ".join(sorted(error_list, reverse=True)))
 
 
 if __name__ == "__main__":
@@ -58,3 +541,4 @@ if __name__ == "__main__":
         main()
     except Exception:
         print(traceback.format_exc())
+        sys.exit(1)
@@ -0,0 +1,49 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+import ga4_from_sql_to_postgres as sql_to_postgres
+
+
+def make_files(tmp_path):
+    path_list = []
+    for table_name in ("events_20221102", "events_20221101"):
+        path = tmp_path / "202211" / f"{table_name}.copy"
+        path.parent.mkdir(exist_ok=True)
+        path.write_text("row\n", encoding="utf-8")
+        path_list.append(str(path))
+    return path_list
+
+
+def make_manifest(path_list):
+    # 2つともロード済みで、変換も終わっている
+    manifest = {"partitions": {}}
+    for in_path_str in path_list:
+        manifest["partitions"][sql_to_postgres.partition_name(in_path_str)] = {
+            "avro_to_sql": {"state": "done", "size": Path(in_path_str).stat().st_size},
+            "sql_to_postgres": {"state": "done", "source": sql_to_postgres.sql_file_identity(in_path_str)},
+        }
+    return manifest
+
+
+def test_select_load_files_skips_unchanged_partitions(tmp_path):
+    path_list = make_files(tmp_path)
+    manifest = make_manifest(path_list)
+    Path(path_list[1]).write_text("row\nrow\n", encoding="utf-8")
+    manifest["partitions"]["events_20221101"]["avro_to_sql"]["size"] = Path(path_list[1]).stat().st_size
+    assert sql_to_postgres.select_load_files(path_list, manifest, True) == ([path_list[1]], [])
+
+
+def test_select_load_files_reloads_when_events_missing(tmp_path):
+    # データベース・eventsテーブルを作り直した場合は、ロード済みの記録があってもロードする
+    path_list = make_files(tmp_path)
+    manifest = make_manifest(path_list)
+    assert sql_to_postgres.select_load_files(path_list, manifest, False) == (path_list, [])
+
+
+def test_select_load_files_skips_incomplete_conversion(tmp_path):
+    path_list = make_files(tmp_path)
+    manifest = make_manifest(path_list)
+    manifest["partitions"]["events_20221102"]["avro_to_sql"]["state"] = "converting"
+    assert sql_to_postgres.select_load_files(path_list, manifest, False) == ([path_list[1]], [path_list[0]])
@@ -0,0 +1,16 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+import ga4_from_sql_to_postgres as sql_to_postgres
+
+
+def test_parse_copy_row_unescapes_values():
+    line = "a\\tb\t\\N\t{\"(\\\\\"x\\\\\\\\y\\\\\")\"}\t\\\\t\\n\tplain\n"
+    assert sql_to_postgres.parse_copy_row(line) == ["a\tb", None, '{"(\\"x\\\\y\\")"}', "\\t\n", "plain"]
+
+
+def test_parse_copy_row_keeps_escaped_backslash_before_letters():
+    # 「\\N」はNULLではなく「\N」という文字列
+    assert sql_to_postgres.parse_copy_row("\\\\N\t\\\\\\\\\t\\q\n") == ["\\N", "\\\\", "q"]
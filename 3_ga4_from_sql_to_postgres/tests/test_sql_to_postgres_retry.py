@@ -0,0 +1,39 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "deploy"))
+
+import ga4_from_sql_to_postgres as sql_to_postgres
+
+
+class FakeConn:
+    closed = 0
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def getconn(self):
+        return FakeConn()
+
+    def putconn(self, conn, close=False):
+        pass
+
+
+def test_load_partition_with_retry_counts_all_attempts(monkeypatch):
+    attempt_list = []
+
+    def load_partition(conn, in_path_str, batch_size, truncate=False, page_rows=1000):
+        attempt_list.append(truncate)
+        if len(attempt_list) == 1:
+            time.sleep(0.2)
+            raise RuntimeError("connection lost")
+        return 10
+
+    monkeypatch.setattr(sql_to_postgres, "load_partition", load_partition)
+    rows, seconds, error = sql_to_postgres.load_partition_with_retry(FakePool(), "events_20221101.sql", 100, 1)
+    assert (rows, error) == (10, None)
+    assert attempt_list == [False, True]
+    assert 0.2 <= seconds
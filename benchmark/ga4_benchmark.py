@@ -0,0 +1,276 @@
+import sys
+import os
+import time
+import json
+import shutil
+import datetime
+import platform
+import subprocess
+import traceback
+import configparser
+from pathlib import Path
+import fastavro
+
+# ステージ2・3のスクリプトを直接importして、その関数を測る
+REPO_HOME = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_HOME / "2_ga4_from_avro_to_sql" / "deploy"))
+sys.path.insert(0, str(REPO_HOME / "3_ga4_from_sql_to_postgres" / "deploy"))
+
+import ga4_from_avro_to_sql as avro_to_sql
+from ga4_synthetic_avro import write_ga4_avro_files
+
+
+class MyException(Exception):
+    pass
+
+
+def read_config(config_path):
+    config = configparser.ConfigParser()
+    if len(config.read(config_path)) == 0:
+        raise MyException(f"設定ファイルを読み込めませんでした：{config_path}")
+    return config
+
+
+def git_commit():
+    # 結果をコミット同士で比べられるように、測ったときのコミットを記録する
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_HOME, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def measure(name, func, rows, bytes_in=None, repeat=1):
+    # repeat回実行して最も速かった回の秒数から、行/秒・バイト/秒を求める
+    seconds_list = []
+    bytes_out = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bytes_out = func()
+        seconds_list.append(time.perf_counter() - start)
+    seconds = min(seconds_list)
+    result = {"seconds": seconds, "rows": rows, "rows_per_sec": rows / seconds if 0 < seconds else None}
+    if bytes_in is not None:
+        result["bytes_in"] = bytes_in
+        result["bytes_in_per_sec"] = bytes_in / seconds if 0 < seconds else None
+    if bytes_out is not None:
+        result["bytes_out"] = bytes_out
+        result["bytes_out_per_sec"] = bytes_out / seconds if 0 < seconds else None
+    print(f"  {name}: {result['rows_per_sec']:,.0f} 行/秒 ({seconds:.3f} 秒)")
+    return result
+
+
+def bench_functions(avro_list, schema_plan, escape_cache_size, repeat):
+    # ステージ2の関数ごとの速さ（Avroのデコード済みレコードに対して測る）
+    schema = schema_plan["schema"]
+    postgres_type_list = schema_plan["postgres_type_list"]
+    in_path_str = avro_list[0]
+    table_name = Path(in_path_str).stem.lower()
+    bytes_in = os.path.getsize(in_path_str)
+
+    with open(in_path_str, "rb") as fi:
+        rec_list = list(fastavro.reader(fi))
+    rows = len(rec_list)
+
+    def decode():
+        with open(in_path_str, "rb") as fi:
+            for _ in fastavro.reader(fi):
+                pass
+
+    results = {}
+    results["avro_decode"] = measure("avro_decode", decode, rows=rows, bytes_in=bytes_in, repeat=repeat)
+
+    def run(make_row):
+        return sum([len(make_row(rec).encode("utf-8")) for rec in rec_list])
+
+    def legacy():
+        return run(lambda rec: avro_to_sql.make_sql_insert(table_name, schema, postgres_type_list, rec))
+
+    def compiled_insert():
+        avro_to_sql.set_escape_cache_size(escape_cache_size)
+        return run(avro_to_sql.compile_sql_insert(table_name, schema, postgres_type_list))
+
+    def compiled_copy():
+        return run(avro_to_sql.compile_copy_row(schema, postgres_type_list))
+
+    # escape()はキャッシュを空にしてから測る（キャッシュが温まった状態だけを測らないように）
+    avro_to_sql.set_escape_cache_size(escape_cache_size)
+    results["make_sql_insert"] = measure("make_sql_insert", legacy, rows=rows, repeat=repeat)
+    results["compile_sql_insert"] = measure("compile_sql_insert", compiled_insert, rows=rows, repeat=repeat)
+    results["compile_copy_row"] = measure("compile_copy_row", compiled_copy, rows=rows, repeat=repeat)
+
+    string_list = []
+    for rec in rec_list:
+        for param in rec["event_params"]:
+            string_list.append(param["key"])
+            if param["value"]["string_value"] is not None:
+                string_list.append(param["value"]["string_value"])
+
+    def escape():
+        avro_to_sql.set_escape_cache_size(escape_cache_size)
+        for ss in string_list:
+            avro_to_sql.escape(ss)
+
+    results["escape"] = measure("escape", escape, rows=len(string_list), repeat=repeat)
+    hits, misses = avro_to_sql.escape_cache_counts()
+    results["escape"]["cache_hit_rate"] = hits / (hits + misses) if 0 < hits + misses else None
+    return results
+
+
+def bench_convert(avro_list, schema_plan, sql_home, escape_cache_size, repeat):
+    # ステージ2の変換をファイル単位で（読み込み・変換・書き出しまで）測る
+    results = {}
+    for output_format in ("insert", "copy", "prepared"):
+        out_dir = sql_home / output_format
+        out_dir.mkdir(parents=True, exist_ok=True)
+        out_path_list = []
+
+        def convert():
+            avro_to_sql.set_escape_cache_size(escape_cache_size)
+            out_path_list.clear()
+            for in_path_str in avro_list:
+                table_name = Path(in_path_str).stem.lower()
+                out_path = out_dir / (table_name + avro_to_sql.OUTPUT_SUFFIX[output_format])
+                convert_result = avro_to_sql.convert_partition(
+                    in_path_str, str(out_path), table_name, schema_plan["schema"], schema_plan["postgres_type_list"],
+                    "compiled", output_format)
+                counts["rows"] += convert_result["rows"]
+                out_path_list.append(out_path)
+            return sum([out_path.stat().st_size for out_path in out_path_list])
+
+        counts = {"rows": 0}
+        convert()
+        rows = counts["rows"]
+        bytes_in = sum([os.path.getsize(in_path_str) for in_path_str in avro_list])
+        results[output_format] = measure(f"convert_partition({output_format})", convert, rows=rows, bytes_in=bytes_in,
+                                         repeat=repeat)
+        results[output_format]["files"] = [str(out_path) for out_path in out_path_list]
+    return results
+
+
+def bench_load(config, schema_plan, convert_results, repeat):
+    # ステージ3のロードを、使い捨てのデータベースに対して測る（終わったら削除する）
+    import psycopg2
+    import ga4_from_sql_to_postgres as sql_to_postgres
+
+    host = config["postgresql"]["host"]
+    port = config["postgresql"]["port"]
+    dbname = config["postgresql"]["dbname"]
+    user = config["postgresql"]["user"]
+    password = config["postgresql"]["password"]
+    batch_size = config.getint("postgresql", "batch_mb", fallback=16) * 1024 * 1024
+    bench_dbname = f"ga4_benchmark_{os.getpid()}"
+
+    admin_conn = psycopg2.connect(f"host={host} port={port} dbname={dbname} user={user} password={password}")
+    admin_conn.autocommit = True
+    try:
+        with admin_conn.cursor() as cur:
+            cur.execute(f"CREATE DATABASE {bench_dbname}")
+        conn = psycopg2.connect(f"host={host} port={port} dbname={bench_dbname} user={user} password={password}")
+        try:
+            with conn.cursor() as cur:
+                cur.execute(avro_to_sql.make_sql_ddl(schema_plan))
+            conn.commit()
+
+            results = {}
+            for output_format, convert_result in convert_results.items():
+                def load():
+                    for out_path_str in convert_result["files"]:
+                        sql_to_postgres.load_partition(conn, out_path_str, batch_size, truncate=True)
+                    return None
+
+                bytes_in = sum([os.path.getsize(out_path_str) for out_path_str in convert_result["files"]])
+                results[output_format] = measure(f"load_partition({output_format})", load,
+                                                 rows=convert_result["rows"], bytes_in=bytes_in, repeat=repeat)
+        finally:
+            conn.close()
+    finally:
+        with admin_conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS {bench_dbname}")
+        admin_conn.close()
+    return results
+
+
+def compare(result, baseline):
+    # 前回の結果と行/秒を比べる
+    print(f"比較：{baseline['git_commit']} ({baseline['created_at']})")
+    for stage, stage_results in result["results"].items():
+        for name, values in stage_results.items():
+            base_values = baseline["results"].get(stage, {}).get(name)
+            if base_values is None or not base_values.get("rows_per_sec") or not values.get("rows_per_sec"):
+                continue
+            ratio = values["rows_per_sec"] / base_values["rows_per_sec"]
+            print(f"  {stage}.{name}: {base_values['rows_per_sec']:,.0f} -> {values['rows_per_sec']:,.0f} 行/秒 ({ratio:.2f}倍)")
+
+
+def write_result(result_path, result):
+    with open(result_path, "wt", encoding="utf-8") as fo:
+        json.dump(result, fo, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました：{result_path}")
+
+
+def main():
+    config_path = Path.cwd() / "ga4_benchmark.ini"
+    config = read_config(config_path)
+
+    # 合成データの大きさと偏り
+    rows = config.getint("synthetic", "rows", fallback=20000)
+    days = config.getint("synthetic", "days", fallback=2)
+    skew = config.getfloat("synthetic", "skew", fallback=1.1)
+    seed = config.getint("synthetic", "seed", fallback=0)
+    block_kb = config.getint("synthetic", "block_kb", fallback=64)
+    first_day = datetime.date.fromisoformat(config.get("synthetic", "first_day", fallback="2022-11-01"))
+
+    repeat = config.getint("benchmark", "repeat", fallback=3)
+    escape_cache_size = config.getint("benchmark", "escape_cache_size", fallback=avro_to_sql.ESCAPE_CACHE_SIZE)
+    work_home = Path(config.get("benchmark", "work_home", fallback="ga4_benchmark_work"))
+    result_path = Path(config.get("benchmark", "result_path", fallback="ga4_benchmark_result.json"))
+    baseline_path = config.get("benchmark", "baseline_path", fallback="")
+
+    params = {"rows": rows, "days": days, "skew": skew, "seed": seed, "block_kb": block_kb,
+              "first_day": first_day.isoformat(), "repeat": repeat, "escape_cache_size": escape_cache_size}
+
+    if work_home.exists():
+        shutil.rmtree(work_home)
+    avro_home = work_home / "avro"
+    sql_home = work_home / "sql"
+
+    result = {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": {},
+    }
+
+    try:
+        print(f"合成データを作成します：{days} 日 x {rows} 行")
+        avro_list = write_ga4_avro_files(avro_home, first_day, days, rows, seed=seed, skew=skew, block_size=block_kb * 1024)
+        schema_plan = avro_to_sql.make_schema_plan(avro_list, "events")
+
+        print("関数ごとの速さ")
+        result["results"]["functions"] = bench_functions(avro_list, schema_plan, escape_cache_size, repeat)
+        print("ステージ2（Avro -> SQL）")
+        convert_results = bench_convert(avro_list, schema_plan, sql_home, escape_cache_size, repeat)
+        result["results"]["avro_to_sql"] = {output_format: {k: v for k, v in values.items() if k != "files"}
+                                            for output_format, values in convert_results.items()}
+        # ステージ3の測定に失敗しても、ステージ2までの結果は残す
+        write_result(result_path, result)
+        if config.has_section("postgresql"):
+            print("ステージ3（SQL -> PostgreSQL）")
+            result["results"]["sql_to_postgres"] = bench_load(config, schema_plan, convert_results, repeat)
+            write_result(result_path, result)
+    finally:
+        shutil.rmtree(work_home, ignore_errors=True)
+
+    if baseline_path != "":
+        with open(baseline_path, "rt", encoding="utf-8") as fi:
+            compare(result, json.load(fi))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        print(traceback.format_exc())
+        sys.exit(1)
@@ -0,0 +1,251 @@
+import random
+import datetime
+from pathlib import Path
+import fastavro
+
+# BigQueryのGA4エクスポート（events_YYYYMMDD）をAvroで抽出したときと同じ形のスキーマ
+# NULLABLEの列は ["null", 型]、REPEATEDの列は配列になる
+
+
+def nullable(avro_type):
+    return ["null", avro_type]
+
+
+def record(name, field_list):
+    return {
+        "type": "record",
+        "name": name,
+        "fields": [{"name": field_name, "type": field_type, "default": None} if type(field_type) is list
+                   else {"name": field_name, "type": field_type}
+                   for field_name, field_type in field_list],
+    }
+
+
+def string_fields(*name_list):
+    return [(name, nullable("string")) for name in name_list]
+
+
+def make_ga4_schema():
+    event_params_value = record("event_params_value", [
+        ("string_value", nullable("string")),
+        ("int_value", nullable("long")),
+        ("float_value", nullable("double")),
+        ("double_value", nullable("double")),
+    ])
+    user_properties_value = record("user_properties_value", [
+        ("string_value", nullable("string")),
+        ("int_value", nullable("long")),
+        ("float_value", nullable("double")),
+        ("double_value", nullable("double")),
+        ("set_timestamp_micros", nullable("long")),
+    ])
+    item = record("items", string_fields("item_id", "item_name", "item_brand", "item_variant", "item_category",
+                                         "item_category2", "item_category3", "item_category4", "item_category5") + [
+        ("price_in_usd", nullable("double")),
+        ("price", nullable("double")),
+        ("quantity", nullable("long")),
+        ("item_revenue_in_usd", nullable("double")),
+        ("item_revenue", nullable("double")),
+        ("item_refund_in_usd", nullable("double")),
+        ("item_refund", nullable("double")),
+    ] + string_fields("coupon", "affiliation", "location_id", "item_list_id", "item_list_name", "item_list_index",
+                      "promotion_id", "promotion_name", "creative_name", "creative_slot"))
+    return record("Root", [
+        ("event_date", nullable("string")),
+        ("event_timestamp", nullable("long")),
+        ("event_name", nullable("string")),
+        ("event_params", {"type": "array", "items": record("event_params", [
+            ("key", nullable("string")),
+            ("value", nullable(event_params_value)),
+        ])}),
+        ("event_previous_timestamp", nullable("long")),
+        ("event_value_in_usd", nullable("double")),
+        ("event_bundle_sequence_id", nullable("long")),
+        ("event_server_timestamp_offset", nullable("long")),
+        ("user_id", nullable("string")),
+        ("user_pseudo_id", nullable("string")),
+        ("privacy_info", nullable(record("privacy_info", string_fields(
+            "analytics_storage", "ads_storage", "uses_transient_token")))),
+        ("user_properties", {"type": "array", "items": record("user_properties", [
+            ("key", nullable("string")),
+            ("value", nullable(user_properties_value)),
+        ])}),
+        ("user_first_touch_timestamp", nullable("long")),
+        ("user_ltv", nullable(record("user_ltv", [
+            ("revenue", nullable("double")),
+            ("currency", nullable("string")),
+        ]))),
+        ("device", nullable(record("device", string_fields(
+            "category", "mobile_brand_name", "mobile_model_name", "mobile_marketing_name", "mobile_os_hardware_model",
+            "operating_system", "operating_system_version", "vendor_id", "advertising_id", "language",
+            "is_limited_ad_tracking") + [
+            ("time_zone_offset_seconds", nullable("long")),
+        ] + string_fields("browser", "browser_version") + [
+            ("web_info", nullable(record("web_info", string_fields("browser", "browser_version", "hostname")))),
+        ]))),
+        ("geo", nullable(record("geo", string_fields(
+            "continent", "country", "region", "city", "sub_continent", "metro")))),
+        ("app_info", nullable(record("app_info", string_fields(
+            "id", "version", "install_store", "firebase_app_id", "install_source")))),
+        ("traffic_source", nullable(record("traffic_source", string_fields("name", "medium", "source")))),
+        ("stream_id", nullable("string")),
+        ("platform", nullable("string")),
+        ("event_dimensions", nullable(record("event_dimensions", string_fields("hostname")))),
+        ("ecommerce", nullable(record("ecommerce", [
+            ("total_item_quantity", nullable("long")),
+            ("purchase_revenue_in_usd", nullable("double")),
+            ("purchase_revenue", nullable("double")),
+            ("refund_value_in_usd", nullable("double")),
+            ("refund_value", nullable("double")),
+            ("shipping_value_in_usd", nullable("double")),
+            ("shipping_value", nullable("double")),
+            ("tax_value_in_usd", nullable("double")),
+            ("tax_value", nullable("double")),
+            ("unique_items", nullable("long")),
+            ("transaction_id", nullable("string")),
+        ]))),
+        ("items", {"type": "array", "items": item}),
+    ])
+
+
+class SkewedChoice:
+    # 上位の値ほど出やすい（順位^skew に反比例する）選び方。skew=0なら一様
+    def __init__(self, rnd, value_list, skew):
+        self.rnd = rnd
+        self.value_list = value_list
+        self.cum_weights = []
+        total = 0.0
+        for rank in range(1, len(value_list) + 1):
+            total += 1.0 / rank ** skew
+            self.cum_weights.append(total)
+
+    def __call__(self):
+        return self.rnd.choices(self.value_list, cum_weights=self.cum_weights)[0]
+
+
+class Ga4RowGenerator:
+    def __init__(self, seed=0, skew=1.1, distinct_users=100000, distinct_pages=5000, distinct_items=2000):
+        rnd = random.Random(seed)
+        self.rnd = rnd
+        self.event_name = SkewedChoice(rnd, [
+            "page_view", "user_engagement", "scroll", "session_start", "first_visit", "view_item",
+            "view_promotion", "select_item", "add_to_cart", "begin_checkout", "add_shipping_info",
+            "add_payment_info", "purchase", "click", "view_search_results"], skew)
+        self.user = SkewedChoice(rnd, [f"{rnd.randrange(10 ** 9)}.{rnd.randrange(10 ** 10)}"
+                                       for _ in range(distinct_users)], skew)
+        self.page = SkewedChoice(rnd, [f"https://shop.example.com/{rnd.choice(['item', 'category', 'search'])}/{n}"
+                                       for n in range(distinct_pages)], skew)
+        self.title = SkewedChoice(rnd, [f"商品ページ {n} | Example Shop" for n in range(distinct_pages)], skew)
+        self.item_id = SkewedChoice(rnd, [f"GGOE{n:06d}" for n in range(distinct_items)], skew)
+        self.country = SkewedChoice(rnd, [
+            ("Asia", "Japan", "Tokyo", "Shinjuku"), ("Asia", "Japan", "Osaka", "Osaka"),
+            ("Americas", "United States", "California", "San Jose"), ("Europe", "United Kingdom", "England", "London"),
+            ("Americas", "Canada", "Ontario", "Toronto"), ("Asia", "India", "Karnataka", "Bengaluru")], skew)
+        self.device = SkewedChoice(rnd, [
+            ("desktop", "Google", "Chrome", "Windows", "Windows 10", "ja-jp"),
+            ("mobile", "Apple", "Safari", "iOS", "iOS 16.1", "ja-jp"),
+            ("mobile", "Google", "Chrome", "Android", "Android 13", "en-us"),
+            ("tablet", "Apple", "Safari", "iOS", "iPadOS 16.1", "en-gb")], skew)
+        self.traffic_source = SkewedChoice(rnd, [
+            ("(direct)", "(none)", "(direct)"), ("(organic)", "organic", "google"),
+            ("(referral)", "referral", "shop.example.com"), ("Data Share Promo", "cpc", "google")], skew)
+
+    def event_param(self, key, string_value=None, int_value=None, double_value=None):
+        return {"key": key, "value": {
+            "string_value": string_value, "int_value": int_value, "float_value": None, "double_value": double_value}}
+
+    def make_row(self, event_date, event_timestamp):
+        rnd = self.rnd
+        event_name = self.event_name()
+        continent, country, region, city = self.country()
+        category, brand, browser, os_name, os_version, language = self.device()
+        source_name, medium, source = self.traffic_source()
+        event_params = [
+            self.event_param("page_location", string_value=self.page()),
+            self.event_param("page_title", string_value=self.title()),
+            self.event_param("ga_session_id", int_value=rnd.randrange(10 ** 9, 10 ** 10)),
+            self.event_param("ga_session_number", int_value=rnd.randint(1, 30)),
+            self.event_param("engagement_time_msec", int_value=rnd.randint(1, 60000)),
+        ]
+        if rnd.random() < 0.3:
+            event_params.append(self.event_param("percent_scrolled", int_value=90))
+        item_list = []
+        ecommerce = None
+        if event_name in ("view_item", "select_item", "add_to_cart", "begin_checkout", "purchase"):
+            for _ in range(rnd.randint(1, 4)):
+                price = round(rnd.uniform(1, 200), 2)
+                quantity = rnd.randint(1, 3)
+                item_list.append({
+                    "item_id": self.item_id(), "item_name": "(not set)", "item_brand": "Google",
+                    "item_variant": "(not set)", "item_category": "Apparel", "item_category2": None,
+                    "item_category3": None, "item_category4": None, "item_category5": None,
+                    "price_in_usd": price, "price": price, "quantity": quantity,
+                    "item_revenue_in_usd": price * quantity if event_name == "purchase" else None,
+                    "item_revenue": price * quantity if event_name == "purchase" else None,
+                    "item_refund_in_usd": None, "item_refund": None, "coupon": None, "affiliation": None,
+                    "location_id": None, "item_list_id": None, "item_list_name": None, "item_list_index": None,
+                    "promotion_id": None, "promotion_name": None, "creative_name": None, "creative_slot": None,
+                })
+            ecommerce = {
+                "total_item_quantity": sum([item["quantity"] for item in item_list]),
+                "purchase_revenue_in_usd": None, "purchase_revenue": None, "refund_value_in_usd": None,
+                "refund_value": None, "shipping_value_in_usd": None, "shipping_value": None,
+                "tax_value_in_usd": None, "tax_value": None, "unique_items": len(item_list),
+                "transaction_id": f"T{rnd.randrange(10 ** 6)}" if event_name == "purchase" else None,
+            }
+        return {
+            "event_date": event_date,
+            "event_timestamp": event_timestamp,
+            "event_name": event_name,
+            "event_params": event_params,
+            "event_previous_timestamp": None,
+            "event_value_in_usd": None,
+            "event_bundle_sequence_id": None,
+            "event_server_timestamp_offset": None,
+            "user_id": None,
+            "user_pseudo_id": self.user(),
+            "privacy_info": {"analytics_storage": None, "ads_storage": None, "uses_transient_token": "No"},
+            "user_properties": [],
+            "user_first_touch_timestamp": event_timestamp - rnd.randrange(10 ** 11),
+            "user_ltv": None if rnd.random() < 0.8 else {"revenue": round(rnd.uniform(0, 500), 2), "currency": "USD"},
+            "device": {
+                "category": category, "mobile_brand_name": brand, "mobile_model_name": browser,
+                "mobile_marketing_name": "<Other>", "mobile_os_hardware_model": None, "operating_system": os_name,
+                "operating_system_version": os_version, "vendor_id": None, "advertising_id": None,
+                "language": language, "is_limited_ad_tracking": "No", "time_zone_offset_seconds": None,
+                "browser": None, "browser_version": None,
+                "web_info": {"browser": browser, "browser_version": "107.0", "hostname": "shop.example.com"},
+            },
+            "geo": {"continent": continent, "country": country, "region": region, "city": city,
+                    "sub_continent": "(not set)", "metro": "(not set)"},
+            "app_info": None,
+            "traffic_source": {"name": source_name, "medium": medium, "source": source},
+            "stream_id": "1234567890",
+            "platform": "WEB",
+            "event_dimensions": None,
+            "ecommerce": ecommerce,
+            "items": item_list,
+        }
+
+    def make_rows(self, day, rows):
+        event_date = day.strftime("%Y%m%d")
+        start = int(datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc).timestamp()) * 10 ** 6
+        for n in range(rows):
+            yield self.make_row(event_date, start + n * (86400 * 10 ** 6 // max(rows, 1)))
+
+
+def write_ga4_avro_files(out_home, first_day, days, rows, seed=0, skew=1.1, block_size=64 * 1024):
+    # out_home/yyyymm/events_yyyymmdd.avro を days日分作り、パスのリストを返す
+    # BigQueryの抽出（compression="DEFLATE"）と同じく deflate で圧縮する
+    schema = fastavro.parse_schema(make_ga4_schema())
+    generator = Ga4RowGenerator(seed=seed, skew=skew)
+    path_list = []
+    for n in range(days):
+        day = first_day + datetime.timedelta(days=n)
+        out_dir = Path(out_home) / day.strftime("%Y%m")
+        out_dir.mkdir(parents=True, exist_ok=True)  # ディレクトリがなければ作成
+        out_path = out_dir / f"events_{day.strftime('%Y%m%d')}.avro"
+        with open(out_path, "wb") as fo:
+            fastavro.writer(fo, schema, generator.make_rows(day, rows), codec="deflate", sync_interval=block_size)
+        path_list.append(str(out_path))
+    return path_list